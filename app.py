@@ -3,21 +3,43 @@ import io
 import re
 import logging
 import json
+import hashlib
+import threading
+import queue
+import time
+import signal
+import contextvars
+import tracemalloc
+import sys
+from contextlib import contextmanager
+from collections import OrderedDict
 from logging.handlers import RotatingFileHandler
-from datetime import datetime
-from flask import Flask, request, abort
+from datetime import datetime, timedelta
+import csv
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+from flask import Flask, request, abort, Response, stream_with_context, send_file
 from dotenv import load_dotenv
-import psycopg2
+from circuit_breaker import CircuitBreaker
+from storage import StorageBackend, LocalCASStorage, S3Storage
+from counters import SlidingWindowCounter, SQLiteSequenceCounter
+from scheduler import ShardedScheduler, WatermarkGate
+from line_http import PooledHttpClient
+from msg_archive import MessageArchive
+from media_cache import DiskLRUCache
+from retention import RetentionManager
+from user_directory import JsonFileUserDirectory, PostgresUserDirectory
+from outbox import Outbox
 
-# LINE Bot SDK
-from linebot import LineBotApi, WebhookHandler
+# LINE Bot SDK (the webhook parser and handler registration need the models at import time)
+from linebot import LineBotApi, WebhookParser
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import MessageEvent, TextMessage, ImageMessage, VideoMessage, PostbackEvent, TextSendMessage
 
-# Google Drive API imports
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+# psycopg2 and the Google client libraries are imported lazily inside the functions
+# that use them, so the app can answer webhooks before they are loaded.
 
 # ===================== Logging Setup =====================
 LOG_FILE = 'app.log'
@@ -39,32 +61,162 @@ load_dotenv()
 # LINE credentials
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
+# Keep-alive connections to the LINE API and (connect, read) timeouts in seconds
+LINE_HTTP_POOL_SIZE = int(os.getenv("LINE_HTTP_POOL_SIZE", "10"))
+LINE_CONNECT_TIMEOUT = float(os.getenv("LINE_CONNECT_TIMEOUT", "3.05"))
+LINE_READ_TIMEOUT = float(os.getenv("LINE_READ_TIMEOUT", "30"))
 # Database credentials
 DB_HOST = os.getenv("PGHOST")
 DB_PORT = os.getenv("PGPORT")
 DB_NAME = os.getenv("PGDATABASE")
 DB_USER = os.getenv("PGUSER")
 DB_PASSWORD = os.getenv("PGPASSWORD")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "50"))
+DB_BATCH_INTERVAL = float(os.getenv("DB_BATCH_INTERVAL", "2.0"))
 # Google Drive credentials
 GOOGLE_DRIVE_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
+# Day folders on Drive: flat (<root>/YYYY-MM-DD, default) or nested (<root>/YYYY/MM/DD)
+DRIVE_FOLDER_LAYOUT = os.getenv("DRIVE_FOLDER_LAYOUT", "flat")
 # Application Port
 PORT = os.getenv("PORT")
+# Media storage backend: drive (default), local or s3
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "drive")
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", "./storage")
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+# Per-minute media sequence numbers: memory (default), sqlite or postgres (shared across workers)
+SEQUENCE_COUNTER = os.getenv("SEQUENCE_COUNTER", "memory")
+SEQUENCE_COUNTER_SQLITE_PATH = os.getenv("SEQUENCE_COUNTER_SQLITE_PATH", "./sequences.db")
+SEQUENCE_HORIZON_MINUTES = int(os.getenv("SEQUENCE_HORIZON_MINUTES", "60"))
+# Worker lanes for webhook events (same conversation -> same lane); 0 handles events inline
+EVENT_LANES = int(os.getenv("EVENT_LANES", "4"))
+# Extra LINE channels hosted by this process, as a JSON file:
+#   {"<name>": {"channel_secret": ..., "channel_access_token": ..., "drive_folder_id": ...,
+#               "user_mapping": {"<user_id>": "<name>"}, "max_concurrency": 2}}
+# drive_folder_id defaults to GOOGLE_DRIVE_FOLDER_ID, max_concurrency to EVENT_LANES.
+CHANNELS_CONFIG = os.getenv("CHANNELS_CONFIG")
+# Token required by admin endpoints such as /export (disabled when unset)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Display names: file (USER_DIRECTORY_FILE, default) or postgres (user_directory table),
+# reloaded on change without a restart
+USER_DIRECTORY = os.getenv("USER_DIRECTORY", "file")
+USER_DIRECTORY_FILE = os.getenv(
+    "USER_DIRECTORY_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "user_mapping.json")
+)
+USER_DIRECTORY_POLL_INTERVAL = float(os.getenv("USER_DIRECTORY_POLL_INTERVAL", "5"))
 
-if not LINE_CHANNEL_SECRET or not LINE_CHANNEL_ACCESS_TOKEN:
-    raise Exception("Please set LINE_CHANNEL_SECRET and LINE_CHANNEL_ACCESS_TOKEN in your environment.")
+if bool(LINE_CHANNEL_SECRET) != bool(LINE_CHANNEL_ACCESS_TOKEN) or not (LINE_CHANNEL_SECRET or CHANNELS_CONFIG):
+    raise Exception("Please set LINE_CHANNEL_SECRET and LINE_CHANNEL_ACCESS_TOKEN (or CHANNELS_CONFIG) in your environment.")
 if not DB_HOST or not DB_PORT or not DB_NAME or not DB_USER or not DB_PASSWORD:
     raise Exception("Please set DB_HOST, DB_PORT, DB_NAME, DB_USER, and DB_PASSWORD in your environment.")
 if not GOOGLE_DRIVE_FOLDER_ID:
     raise Exception("Please set GOOGLE_DRIVE_FOLDER_ID in your environment.")
 if not PORT:
     raise Exception("Please set PORT in your environment.")
+if DRIVE_FOLDER_LAYOUT not in ("flat", "nested"):
+    raise Exception("DRIVE_FOLDER_LAYOUT must be one of: flat, nested.")
+if SEQUENCE_COUNTER not in ("memory", "sqlite", "postgres"):
+    raise Exception("SEQUENCE_COUNTER must be one of: memory, sqlite, postgres.")
+if STORAGE_BACKEND not in ("drive", "local", "s3"):
+    raise Exception("STORAGE_BACKEND must be one of: drive, local, s3.")
+if USER_DIRECTORY not in ("file", "postgres"):
+    raise Exception("USER_DIRECTORY must be one of: file, postgres.")
+if STORAGE_BACKEND == "s3" and not S3_BUCKET:
+    raise Exception("Please set S3_BUCKET in your environment when STORAGE_BACKEND=s3.")
 
 # ===================== Initialize LINE Bot API =====================
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+# One keep-alive session shared by every channel's content downloads, profiles and replies
+line_http_client = PooledHttpClient(timeout=(LINE_CONNECT_TIMEOUT, LINE_READ_TIMEOUT), pool_size=LINE_HTTP_POOL_SIZE)
+# Registry of the event handlers below, shared by every channel:
+# (event class, message class or None) -> function
+event_handlers = {}
+
+def on_event(event, message=None):
+    """Register an event handler, like WebhookHandler.add (`message` may be a list of classes)."""
+    def decorator(func):
+        for message_type in (message if isinstance(message, (list, tuple)) else [message]):
+            event_handlers[(event, message_type)] = func
+        return func
+    return decorator
+
+def find_event_handler(event):
+    """The handler for a parsed event: its message type's, else its event type's, else None."""
+    func = None
+    if isinstance(event, MessageEvent):
+        func = event_handlers.get((type(event), type(event.message)))
+    return func or event_handlers.get((type(event), None))
+
+# ===================== Channels =====================
+# The channel from LINE_CHANNEL_* is served at /callback; channels from CHANNELS_CONFIG at
+# /callback/<name>. Each has its own credentials, Drive root, user mapping and event lanes
+# (its concurrency quota), and shares the DB, Drive and HTTP pools and caches.
+DEFAULT_CHANNEL = "default"
+
+class Channel:
+    """One LINE channel (bot) hosted by this process."""
+
+    def __init__(self, name, channel_secret, channel_access_token, drive_folder_id, user_mapping, lanes):
+        self.name = name
+        self.line_bot_api = LineBotApi(channel_access_token, http_client=lambda timeout: line_http_client)
+        self.parser = WebhookParser(channel_secret)
+        self.drive_folder_id = drive_folder_id
+        self.user_mapping = user_mapping
+        self.scheduler = ShardedScheduler(f"events-{name}", lanes=lanes, logger=logger)
+
+# Static user mapping from the environment variable; superseded by the user directory and
+# only consulted for users it does not know
+def load_user_mapping():
+    user_mapping_json = os.getenv("USER_MAPPING_JSON")
+    return json.loads(user_mapping_json) if user_mapping_json else {}
+
+def load_channels():
+    """Build the 'default' channel (when LINE_CHANNEL_* is set) and those in CHANNELS_CONFIG."""
+    channels = {}
+    if LINE_CHANNEL_SECRET:
+        channels[DEFAULT_CHANNEL] = Channel(DEFAULT_CHANNEL, LINE_CHANNEL_SECRET, LINE_CHANNEL_ACCESS_TOKEN,
+                                            GOOGLE_DRIVE_FOLDER_ID, load_user_mapping(), EVENT_LANES)
+    if CHANNELS_CONFIG:
+        with open(CHANNELS_CONFIG, encoding="utf-8") as f:
+            config = json.load(f)
+        for name, conf in config.items():
+            if not re.fullmatch(r"[A-Za-z0-9_\-]+", name) or name in channels:
+                raise Exception(f"Invalid or duplicate channel name '{name}' in {CHANNELS_CONFIG}.")
+            if not conf.get("channel_secret") or not conf.get("channel_access_token"):
+                raise Exception(f"Channel '{name}' in {CHANNELS_CONFIG} needs channel_secret and channel_access_token.")
+            channels[name] = Channel(
+                name, conf["channel_secret"], conf["channel_access_token"],
+                conf.get("drive_folder_id", GOOGLE_DRIVE_FOLDER_ID), conf.get("user_mapping", {}),
+                int(conf.get("max_concurrency", EVENT_LANES))
+            )
+    return channels
+
+channels = load_channels()
+_current_channel = contextvars.ContextVar("channel", default=None)
+
+def current_channel():
+    """The channel whose event is being handled (the default, or first, channel otherwise)."""
+    return _current_channel.get() or channels.get(DEFAULT_CHANNEL) or next(iter(channels.values()))
+
+@contextmanager
+def channel_context(channel):
+    """Run the block on behalf of `channel`."""
+    token = _current_channel.set(channel)
+    try:
+        yield channel
+    finally:
+        _current_channel.reset(token)
+
+def line_api():
+    """LineBotApi of the current channel."""
+    return current_channel().line_bot_api
 
 # ===================== Local Backup Setup =====================
 OUTPUT_DIR = "./output"
+DAY_FOLDER_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
 if not os.path.exists(OUTPUT_DIR):
     os.makedirs(OUTPUT_DIR)
 
@@ -72,9 +224,13 @@ def sanitize_filename(name):
     """Remove illegal characters from a filename."""
     return re.sub(r'[^A-Za-z0-9_\-]+', '', name)
 
+def channel_output_dir(channel):
+    """Channels other than the default one keep their local files under OUTPUT_DIR/channels/<name>."""
+    return OUTPUT_DIR if channel.name == DEFAULT_CHANNEL else os.path.join(OUTPUT_DIR, "channels", channel.name)
+
 def get_daily_folder(dt):
     """Return a local folder for the given day (YYYY-MM-DD); create if not exists."""
-    folder = os.path.join(OUTPUT_DIR, dt.strftime("%Y-%m-%d"))
+    folder = os.path.join(channel_output_dir(current_channel()), dt.strftime("%Y-%m-%d"))
     if not os.path.exists(folder):
         os.makedirs(folder)
     return folder
@@ -96,49 +252,629 @@ def save_to_local(file_stream, filename, folder):
     filepath = os.path.join(folder, filename)
     with open(filepath, "wb") as f:
         f.write(file_stream.getvalue())
+    try:
+        output_retention.track(filepath)
+    except Exception as e:
+        logger.error(f"Error tracking {filepath} for retention: {e}")
     return filepath
 
+# ===================== Message Log Archive =====================
+# Every night the _msg.txt files of finished days are compacted into <channel output>/archive:
+# one compressed, block-indexed file per month (see msg_archive.py), which archive_messages.py
+# queries by user and time without scanning every day. The plain files are removed once
+# archived unless MSG_ARCHIVE_KEEP_SOURCE is set; lines that still arrive for an archived
+# day (late redeliveries) recreate the file and are picked up the next night.
+MSG_ARCHIVE_DIR_NAME = "archive"
+MSG_ARCHIVE_BLOCK_RECORDS = int(os.getenv("MSG_ARCHIVE_BLOCK_RECORDS", "500"))
+MSG_ARCHIVE_KEEP_SOURCE = os.getenv("MSG_ARCHIVE_KEEP_SOURCE", "false").lower() in ("1", "true", "yes")
+MSG_ARCHIVE_HOUR = int(os.getenv("MSG_ARCHIVE_HOUR", "3"))
+message_archives = {}
+
+def message_archive(channel):
+    """The MessageArchive holding `channel`'s compacted message logs."""
+    if channel.name not in message_archives:
+        archive_dir = os.path.join(channel_output_dir(channel), MSG_ARCHIVE_DIR_NAME)
+        message_archives[channel.name] = MessageArchive(archive_dir, MSG_ARCHIVE_BLOCK_RECORDS, logger=logger)
+    return message_archives[channel.name]
+
+def compact_message_logs(before=None, keep_source=MSG_ARCHIVE_KEEP_SOURCE):
+    """Archive the _msg.txt of every day before `before` (YYYY-MM-DD, default today); returns records archived."""
+    before = before or datetime.now().strftime("%Y-%m-%d")
+    total = 0
+    for channel in channels.values():
+        base = channel_output_dir(channel)
+        if not os.path.isdir(base):
+            continue
+        archive = message_archive(channel)
+        for day in sorted(name for name in os.listdir(base) if DAY_FOLDER_PATTERN.match(name) and name < before):
+            path = os.path.join(base, day, f"{day}_msg.txt")
+            if not os.path.exists(path) or (keep_source and archive.is_compacted(day)):
+                continue
+            try:
+                total += archive.compact_day(day, path)
+                if not keep_source:
+                    os.remove(path)
+            except Exception as e:
+                logger.error(f"Error archiving {path}: {e}")
+    return total
+
+def run_message_compaction():
+    """Background loop: compact finished days at startup, then nightly at MSG_ARCHIVE_HOUR."""
+    while True:
+        try:
+            compact_message_logs()
+        except Exception as e:
+            logger.error(f"Error compacting message logs: {e}")
+        now = datetime.now()
+        next_run = now.replace(hour=MSG_ARCHIVE_HOUR, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        time.sleep((next_run - now).total_seconds())
+
+# ===================== Output Retention =====================
+# Media saved under OUTPUT_DIR (local fallbacks while storage is down) is tracked in a SQLite
+# usage index and, once confirmed uploaded (pending drain or backfill_output.py), deleted
+# oldest first whenever the tracked files exceed OUTPUT_MAX_MB or are older than
+# OUTPUT_MAX_AGE_DAYS (0 disables either limit). Files never confirmed are never deleted.
+# The day logs, message archive and media cache are managed separately and not tracked.
+OUTPUT_MAX_BYTES = int(os.getenv("OUTPUT_MAX_MB", "0")) * 1024 * 1024
+OUTPUT_MAX_AGE_DAYS = float(os.getenv("OUTPUT_MAX_AGE_DAYS", "0"))
+OUTPUT_RETENTION_INTERVAL = float(os.getenv("OUTPUT_RETENTION_INTERVAL", "300"))
+OUTPUT_RETENTION_INDEX = os.path.join(OUTPUT_DIR, "retention.db")
+
+output_retention = RetentionManager(OUTPUT_DIR, OUTPUT_RETENTION_INDEX, OUTPUT_MAX_BYTES, OUTPUT_MAX_AGE_DAYS,
+                                    logger=logger)
+
+def local_media_paths():
+    """Files in every channel's day folders, apart from the day's message log."""
+    for channel in channels.values():
+        base = channel_output_dir(channel)
+        if not os.path.isdir(base):
+            continue
+        for day in os.listdir(base):
+            day_dir = os.path.join(base, day)
+            if not DAY_FOLDER_PATTERN.match(day) or not os.path.isdir(day_dir):
+                continue
+            for entry in os.scandir(day_dir):
+                if entry.is_file() and not entry.name.endswith("_msg.txt"):
+                    yield entry.path
+
+def run_output_retention():
+    """
+    Background loop: register files that predate the index once, then evict in batches
+    (pausing between them) every OUTPUT_RETENTION_INTERVAL seconds.
+    """
+    if output_retention.is_new:
+        try:
+            added = output_retention.scan(local_media_paths())
+            logger.info(f"Retention index created with {added} existing file(s) (not confirmed uploaded)")
+        except Exception as e:
+            logger.error(f"Error scanning {OUTPUT_DIR} for retention: {e}")
+    while True:
+        if OUTPUT_MAX_BYTES or OUTPUT_MAX_AGE_DAYS:
+            try:
+                while output_retention.enforce():
+                    time.sleep(0.1)
+            except Exception as e:
+                logger.error(f"Error enforcing output retention: {e}")
+        time.sleep(OUTPUT_RETENTION_INTERVAL)
+
 # ===================== Database Functions =====================
-def insert_text_message_to_db(dt, user_id, display_name, text):
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+def get_db_pool():
+    """Return the shared connection pool, creating it on first use."""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                from psycopg2 import pool as pg_pool
+                _db_pool = pg_pool.ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX,
+                    host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
+                )
+                logger.info(f"Created DB connection pool (min={DB_POOL_MIN}, max={DB_POOL_MAX})")
+    return _db_pool
+
+@contextmanager
+def get_db_connection():
     """
-    Insert a text message into the 'messages' table.
-    Expected columns: id, user_id, display_name, message_text, created_at.
+    Borrow a connection from the pool. Commits on success, rolls back on error,
+    and always returns the connection to the pool.
     """
+    db_pool = get_db_pool()
+    # psycopg2's pool raises instead of blocking when exhausted, so wait for a free slot here
+    if not _db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise Exception(f"Timed out after {DB_POOL_TIMEOUT}s waiting for a DB connection")
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
-        )
-        cur = conn.cursor()
-        insert_sql = """
-            INSERT INTO messages (user_id, display_name, message_text, created_at)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id;
+        conn = db_pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            db_pool.putconn(conn)
+    finally:
+        _db_pool_slots.release()
+
+# name -> BatchedWriter, so journaled rows can be handed back to the right writer on restart
+batched_writers = {}
+
+class BatchedWriter:
+    """
+    Buffer rows in memory and insert them with a single multi-row INSERT
+    (execute_values) once the batch is full or the flush interval expires.
+    """
+
+    def __init__(self, name, insert_sql, batch_size=DB_BATCH_SIZE, interval=DB_BATCH_INTERVAL):
+        self.name = name
+        self.insert_sql = insert_sql
+        self.batch_size = batch_size
+        self.interval = interval
+        self._rows = []
+        self._cond = threading.Condition()
+        # Held while a batch is being written, so flush() waits for the background thread
+        self._write_lock = threading.Lock()
+        self._thread = None
+        batched_writers[name] = self
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._cond:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=f"{self.name}-writer", daemon=True)
+                    self._thread.start()
+
+    def add(self, row):
+        """Queue a row (tuple) for insertion."""
+        self._ensure_started()
+        with self._cond:
+            self._rows.append(row)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._rows)
+                self._cond.wait_for(lambda: len(self._rows) >= self.batch_size, timeout=self.interval)
+                batch, self._rows = self._rows, []
+                # Taken before releasing the buffer, so a concurrent flush() waits for this batch
+                self._write_lock.acquire()
+            try:
+                self._write(batch)
+            finally:
+                self._write_lock.release()
+
+    def flush(self):
+        """
+        Synchronously write everything currently buffered (after any batch the
+        background thread is writing). Returns the rows that could not be written.
         """
-        cur.execute(insert_sql, (user_id, display_name, text, dt))
-        new_id = cur.fetchone()[0]
-        conn.commit()
+        with self._cond:
+            batch, self._rows = self._rows, []
+        with self._write_lock:
+            if batch and not self._write(batch):
+                return batch
+            return []
+
+    def _write(self, batch):
+        from psycopg2.extras import execute_values
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cur:
+                    execute_values(cur, self.insert_sql, batch)
+            logger.info(f"Flushed {len(batch)} row(s) to '{self.name}'")
+            return True
+        except Exception as e:
+            logger.error(f"Error flushing {len(batch)} row(s) to '{self.name}': {e}")
+            return False
+
+media_writer = BatchedWriter("media", """
+    INSERT INTO media (message_id, user_id, display_name, created_at, drive_file_id,
+                       day_folder, size_bytes, mime_type, content_hash, channel)
+    VALUES %s
+    ON CONFLICT (message_id) DO NOTHING
+""")
+
+class RollupWriter(BatchedWriter):
+    """
+    BatchedWriter for counter rows (key columns..., increment). Rows with the same key
+    are summed before the upsert, since one statement may update each row only once.
+    """
+
+    def _write(self, batch):
+        totals = {}
+        for *key, increment in batch:
+            totals[tuple(key)] = totals.get(tuple(key), 0) + increment
+        return super()._write([key + (increment,) for key, increment in totals.items()])
+
+def insert_text_message_to_db(dt, user_id, display_name, text):
+    """
+    Insert a text message of the current channel into the 'messages' table.
+    Expected columns: id, user_id, display_name, message_text, created_at, channel.
+    """
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                insert_sql = """
+                    INSERT INTO messages (user_id, display_name, message_text, created_at, channel)
+                    VALUES (%s, %s, %s, %s, %s)
+                    RETURNING id;
+                """
+                cur.execute(insert_sql, (user_id, display_name, text, dt, current_channel().name))
+                new_id = cur.fetchone()[0]
         logger.info(f"Inserted text message into DB with id: {new_id}")
     except Exception as e:
         logger.error(f"Error inserting message into DB: {e}")
+
+SEARCH_PAGE_SIZE = 5
+# Keyset cursor of the last search per (channel, user): (keyword, last_created_at, last_id)
+search_cursors = {}
+
+def escape_like(text):
+    """Escape LIKE/ILIKE wildcards so the keyword is matched literally."""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def search_messages(keyword, after=None, limit=SEARCH_PAGE_SIZE):
+    """
+    Search the current channel's chat history for a keyword, newest first.
+    'search_grams' holds every character and character pair of a message (GIN index), so
+    a message can only contain the keyword if it has all of the keyword's pairs (or its one
+    character); ILIKE then checks the exact substring. This works for 1-2 character CJK
+    keywords, which have no trigrams. It is a single AND-ed condition, so for a common
+    keyword the planner can instead walk the (channel, created_at) index backwards and stop
+    after `limit` rows rather than collect every match before sorting.
+    Until the messages backfill finishes, the default channel's not yet copied history is
+    searched in 'messages_legacy' as well (ILIKE only, without an index).
+    `after` is the (created_at, id) of the last row of the previous page.
+    """
+    channel = current_channel().name
+    pattern = f"%{escape_like(keyword)}%"
+    params = [channel, keyword, pattern]
+    keyset_sql = ""
+    if after:
+        keyset_sql = "AND (created_at, id) < (%s, %s)"
+        params.extend(after)
+    params.append(limit)
+    search_sql = f"""
+        SELECT id, display_name, message_text, created_at
+        FROM messages
+        WHERE channel = %s
+          AND search_grams @@ text_bigram_query(%s)
+          AND message_text ILIKE %s
+        {keyset_sql}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
+    """
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            if channel == DEFAULT_CHANNEL and legacy_backfill_pending(cur):
+                params.append(pattern)
+                legacy_keyset_sql = ""
+                if after:
+                    legacy_keyset_sql = f"AND ({LEGACY_CREATED_AT}, id) < (%s, %s)"
+                    params.extend(after)
+                params.extend([limit, limit])
+                search_sql = f"""
+                    ({search_sql})
+                    UNION ALL
+                    (SELECT id, display_name, message_text, {LEGACY_CREATED_AT}
+                     FROM messages_legacy
+                     WHERE {LEGACY_NOT_COPIED} AND message_text ILIKE %s
+                     {legacy_keyset_sql}
+                     ORDER BY 4 DESC, id DESC
+                     LIMIT %s)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                """
+            cur.execute(search_sql, params)
+            return cur.fetchall()
+
+def format_search_results(keyword, rows):
+    """Format search rows as 'YYYY-MM-DD HH:MM | name | text' lines for a LINE reply."""
+    if not rows:
+        return f"找不到包含「{keyword}」的訊息"
+    lines = [f"「{keyword}」搜尋結果："]
+    for _, display_name, message_text, created_at in rows:
+        lines.append(f"{created_at.strftime('%Y-%m-%d %H:%M')} | {display_name} | {message_text}")
+    if len(rows) == SEARCH_PAGE_SIZE:
+        lines.append("輸入「下一頁」查看更多結果")
+    return "\n".join(lines)
+
+def reply_search_page(reply_token, user_id, keyword, after=None):
+    """Run one page of a search, remember the keyset cursor and reply with the results."""
+    try:
+        rows = search_messages(keyword, after)
+    except Exception as e:
+        logger.error(f"Error searching messages for '{keyword}': {e}")
+        send_reply(reply_token, TextSendMessage(text="搜尋時發生錯誤，請稍後再試"))
+        return
+    if rows:
+        last_id, _, _, last_created_at = rows[-1]
+        search_cursors[(current_channel().name, user_id)] = (keyword, last_created_at, last_id)
+    else:
+        search_cursors.pop((current_channel().name, user_id), None)
+    send_reply(reply_token, TextSendMessage(text=format_search_results(keyword, rows)))
+
+# ===================== Chat Statistics =====================
+# Message counts per (channel, user, period, kind) kept in 'message_stats'. Every text or
+# media message adds 1 to its day, month and all-time rows, so the 統計 command reads at
+# most users x kinds x 3 rows however long the history is.
+STATS_ALL_TIME = datetime(1970, 1, 1).date()
+STATS_KINDS = (("text", "文字"), ("image", "照片"), ("video", "影片"))
+
+stats_writer = RollupWriter("message_stats", """
+    INSERT INTO message_stats (channel, user_id, period, day, kind, count)
+    VALUES %s
+    ON CONFLICT (channel, user_id, period, day, kind)
+    DO UPDATE SET count = message_stats.count + EXCLUDED.count
+""")
+
+def record_stat(user_id, dt, kind):
+    """Count one message of `kind` (text, image or video) for the current channel."""
+    channel = current_channel().name
+    stats_writer.add((channel, user_id, "d", dt.date(), kind, 1))
+    stats_writer.add((channel, user_id, "m", dt.date().replace(day=1), kind, 1))
+    stats_writer.add((channel, user_id, "a", STATS_ALL_TIME, kind, 1))
+
+def query_stats(today):
+    """Return {user_id: {kind: [today, this month, all time]}} for the current channel."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT user_id, kind, period, count FROM message_stats
+                WHERE channel = %s
+                  AND ((period = 'd' AND day = %s) OR (period = 'm' AND day = %s) OR period = 'a');
+            """, (current_channel().name, today, today.replace(day=1), ))
+            rows = cur.fetchall()
+    stats = {}
+    for user_id, kind, period, count in rows:
+        stats.setdefault(user_id, {}).setdefault(kind, [0, 0, 0])["dma".index(period)] = count
+    return stats
+
+def format_stats(stats):
+    if not stats:
+        return "目前還沒有統計資料"
+    lines = ["統計（今日 / 本月 / 全部）"]
+    for user_id, kinds in sorted(stats.items(), key=lambda item: -sum(c[2] for c in item[1].values())):
+        name = get_display_name(user_id)
+        counts = "，".join(f"{label} {'/'.join(map(str, kinds.get(kind, [0, 0, 0])))}" for kind, label in STATS_KINDS)
+        lines.append(f"{name}：{counts}")
+    return "\n".join(lines)
+
+def reply_stats(reply_token):
+    try:
+        stats = query_stats(datetime.now().date())
+    except Exception as e:
+        logger.error(f"Error querying stats: {e}")
+        send_reply(reply_token, TextSendMessage(text="統計時發生錯誤，請稍後再試"))
+        return
+    send_reply(reply_token, TextSendMessage(text=format_stats(stats)))
+
+# ===================== Chat History Export =====================
+EXPORT_ITERSIZE = int(os.getenv("EXPORT_ITERSIZE", "2000"))
+EXPORT_FORMATS = ("ndjson", "csv", "daily")
+
+def iter_messages(start=None, end=None, user_id=None, itersize=EXPORT_ITERSIZE, channel=DEFAULT_CHANNEL):
+    """
+    Yield one channel's (id, user_id, display_name, message_text, created_at) rows in
+    chronological order. Uses a named (server-side) cursor, so only `itersize` rows are held
+    in memory at a time. `start` is inclusive and `end` exclusive; both are datetimes or None.
+    A long export runs on its own connection (connect_db) rather than a pool slot; it is
+    rolled back and closed however the generator ends, including a client disconnecting
+    mid-stream (GeneratorExit). Until the messages backfill finishes, the default channel's
+    not yet copied rows are read from 'messages_legacy' too.
+    """
+    conditions, legacy_conditions, params = [], [LEGACY_NOT_COPIED], []
+    if start:
+        conditions.append("created_at >= %s")
+        legacy_conditions.append(f"{LEGACY_CREATED_AT} >= %s")
+        params.append(start)
+    if end:
+        conditions.append("created_at < %s")
+        legacy_conditions.append(f"{LEGACY_CREATED_AT} < %s")
+        params.append(end)
+    if user_id:
+        conditions.append("user_id = %s")
+        legacy_conditions.append("user_id = %s")
+        params.append(user_id)
+    select_sql = f"""
+        SELECT id, user_id, display_name, message_text, created_at
+        FROM messages
+        WHERE {' AND '.join(["channel = %s"] + conditions)}
+    """
+    conn = connect_db()
+    try:
+        with conn.cursor() as cur:
+            legacy = channel == DEFAULT_CHANNEL and legacy_backfill_pending(cur)
+        if legacy:
+            select_sql += f"""
+                UNION ALL
+                SELECT id, user_id, display_name, message_text, {LEGACY_CREATED_AT}
+                FROM messages_legacy
+                WHERE {' AND '.join(legacy_conditions)}
+            """
+            params = [channel] + params + params
+        else:
+            params = [channel] + params
+        select_sql += " ORDER BY created_at, id;"
+        with conn.cursor(name="export_messages") as cur:
+            cur.itersize = itersize
+            cur.execute(select_sql, params)
+            for row in cur:
+                yield row
     finally:
-        if 'cur' in locals():
-            cur.close()
-        if 'conn' in locals():
+        try:
+            conn.rollback()
+        finally:
             conn.close()
 
+class _LineBuffer:
+    """Minimal file-like object so csv.writer can emit one line at a time."""
+
+    def write(self, value):
+        return value
+
+def format_messages(rows, fmt):
+    """Turn message rows into an iterator of text chunks in the given export format."""
+    if fmt == "ndjson":
+        for msg_id, user_id, display_name, message_text, created_at in rows:
+            yield json.dumps({
+                "id": msg_id,
+                "user_id": user_id,
+                "display_name": display_name,
+                "message_text": message_text,
+                "created_at": created_at.isoformat(),
+            }, ensure_ascii=False) + "\n"
+    elif fmt == "csv":
+        writer = csv.writer(_LineBuffer())
+        yield writer.writerow(["id", "user_id", "display_name", "message_text", "created_at"])
+        for msg_id, user_id, display_name, message_text, created_at in rows:
+            yield writer.writerow([msg_id, user_id, display_name, message_text, created_at.isoformat()])
+    elif fmt == "daily":
+        # Same "HH:MM | name | text" lines as append_text_message, with a header per day
+        current_day = None
+        for _, _, display_name, message_text, created_at in rows:
+            day = created_at.strftime("%Y-%m-%d")
+            if day != current_day:
+                current_day = day
+                yield f"=== {day} ===\n"
+            yield f"{created_at.strftime('%H:%M')} | {display_name} | {message_text}\n"
+    else:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+def record_media(message_id, dt, user_id, display_name, file_id, day_folder, content, mime_type):
+    """
+    Catalog an uploaded media item in the 'media' table.
+    The row is buffered and written in a batch by media_writer.
+    """
+    content_hash = hashlib.sha256(content).hexdigest()
+    media_writer.add((
+        message_id, user_id, display_name, dt, file_id,
+        day_folder, len(content), mime_type, content_hash, current_channel().name
+    ))
+    remember_media(message_id, content_hash, mime_type, file_id)
+    try:
+        media_cache.put(content_hash, content)
+    except OSError as e:
+        logger.error(f"Error caching messageId={message_id}: {e}")
+
 # ===================== Google Drive Helper Functions =====================
+# (parent_id, folder_name) -> folder ID; Drive folder IDs never change, so entries never expire.
+drive_folder_cache = {}
+# googleapiclient service objects are not thread-safe, so each one is lent to a single
+# request at a time; idle clients are kept here for reuse.
+_drive_services = queue.LifoQueue()
+# Drive v3 discovery document: the copy bundled with google-api-python-client (pinned in
+# requirements.txt) unless DRIVE_DISCOVERY_DOC names another file, so building a client
+# never fetches one.
+DRIVE_DISCOVERY_DOC = os.getenv("DRIVE_DISCOVERY_DOC")
+_drive_discovery = None
+# Socket timeout (seconds) for Drive API calls
+DRIVE_HTTP_TIMEOUT = float(os.getenv("DRIVE_HTTP_TIMEOUT", "60"))
+
+def load_drive_discovery():
+    """Return the Drive discovery document (read from disk once)."""
+    global _drive_discovery
+    if _drive_discovery is None:
+        if DRIVE_DISCOVERY_DOC:
+            with open(DRIVE_DISCOVERY_DOC, encoding="utf-8") as f:
+                _drive_discovery = f.read()
+        else:
+            from googleapiclient.discovery_cache import get_static_doc
+            _drive_discovery = get_static_doc("drive", "v3")
+    return _drive_discovery
+
+@contextmanager
+def get_drive_service():
+    """Borrow an idle Drive API client (building a new one if none is free) and return it afterwards."""
+    try:
+        drive_service = _drive_services.get_nowait()
+    except queue.Empty:
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.discovery import build_from_document
+        http = AuthorizedHttp(get_google_credentials(), http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT))
+        drive_service = build_from_document(load_drive_discovery(), http=http)
+    try:
+        yield drive_service
+    finally:
+        _drive_services.put(drive_service)
+
 def get_or_create_subfolder(drive_service, parent_id, folder_name):
     """
     Retrieve or create a subfolder with the given name under the specified parent folder.
+    Results are cached in drive_folder_cache, so each folder is looked up at most once.
+    """
+    cache_key = (parent_id, folder_name)
+    if cache_key in drive_folder_cache:
+        return drive_folder_cache[cache_key]
+    folder_id = _find_or_create_subfolder(drive_service, parent_id, folder_name)
+    drive_folder_cache[cache_key] = folder_id
+    return folder_id
+
+def drive_folder_path(folder):
+    """Folder names from the Drive root down to a logical folder (day folder or album)."""
+    if DRIVE_FOLDER_LAYOUT == "nested" and DAY_FOLDER_PATTERN.match(folder):
+        return folder.split("-")
+    return [folder]
+
+def resolve_drive_folder(drive_service, root_id, folder, create=True):
     """
+    Return the Drive folder ID of a logical folder under root_id, walking the layout's
+    path one level at a time through drive_folder_cache (so YYYY and MM are resolved once).
+    With create=False, returns None if any level does not exist yet.
+    """
+    parent_id = root_id
+    for name in drive_folder_path(folder):
+        if create:
+            parent_id = get_or_create_subfolder(drive_service, parent_id, name)
+            continue
+        cache_key = (parent_id, name)
+        parent_id = drive_folder_cache.get(cache_key) or find_subfolder(drive_service, parent_id, name)
+        if parent_id is None:
+            return None
+        drive_folder_cache[cache_key] = parent_id
+    return parent_id
+
+def drive_query_literal(value):
+    """Quote a value for a Drive files.list `q` string (backslashes and single quotes escaped)."""
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def find_subfolder(drive_service, parent_id, folder_name):
+    """Return the ID of the named subfolder under parent_id, or None if it does not exist."""
     query = (
         "mimeType = 'application/vnd.google-apps.folder' and "
-        f"name = '{folder_name}' and '{parent_id}' in parents and trashed = false"
+        f"name = {drive_query_literal(folder_name)} and {drive_query_literal(parent_id)} in parents "
+        "and trashed = false"
     )
     results = drive_service.files().list(q=query, spaces='drive', fields="files(id, name)").execute()
     items = results.get('files', [])
-    if items:
-        folder_id = items[0]['id']
+    return items[0]['id'] if items else None
+
+def list_folder_files(drive_service, folder_id):
+    """Return {name: file ID} for every file directly inside a Drive folder (one paged listing)."""
+    files = {}
+    page_token = None
+    while True:
+        results = drive_service.files().list(
+            q=f"{drive_query_literal(folder_id)} in parents and trashed = false",
+            spaces='drive', fields="nextPageToken, files(id, name)",
+            pageSize=1000, pageToken=page_token
+        ).execute()
+        for item in results.get('files', []):
+            files[item['name']] = item['id']
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return files
+
+def _find_or_create_subfolder(drive_service, parent_id, folder_name):
+    folder_id = find_subfolder(drive_service, parent_id, folder_name)
+    if folder_id:
         logger.info(f"Found existing subfolder '{folder_name}' with ID: {folder_id}")
         return folder_id
     else:
@@ -152,113 +888,1010 @@ def get_or_create_subfolder(drive_service, parent_id, folder_name):
         logger.info(f"Created new subfolder '{folder_name}' with ID: {folder_id}")
         return folder_id
 
-def upload_image_to_drive(file_stream, filename, day_folder):
+def upload_to_drive(file_stream, filename, day_folder, mimetype, folder_id=None):
     """
-    Upload an image (from a BytesIO stream) to Google Drive under a daily subfolder.
+    Upload a file (from a BytesIO stream) to Google Drive under a daily subfolder,
+    or directly into `folder_id` (e.g. an album folder) when given.
     Duplicate checking is done based on the filename (which includes the LINE message ID).
     """
-    SCOPES = ['https://www.googleapis.com/auth/drive.file']
-    credentials = get_google_credentials()
-    drive_service = build('drive', 'v3', credentials=credentials)
-    
-    # Get (or create) the daily subfolder (e.g., "2025-03-15")
-    subfolder_id = get_or_create_subfolder(drive_service, GOOGLE_DRIVE_FOLDER_ID, day_folder)
-    
-    # Check if the file already exists in this subfolder
-    query = f"name = '{filename}' and '{subfolder_id}' in parents and trashed = false"
-    results = drive_service.files().list(q=query, spaces='drive', fields="files(id)").execute()
-    items = results.get('files', [])
-    if items:
-        logger.info(f"File {filename} already exists in Drive. Skipping upload.")
-        return items[0]['id']
-    
-    file_metadata = {'name': filename, 'parents': [subfolder_id]}
-    file_stream.seek(0)
-    media = MediaIoBaseUpload(file_stream, mimetype='image/jpeg', resumable=True)
-    
+    with get_drive_service() as drive_service:
+        # Get (or create) the daily subfolder (e.g., "2025-03-15") unless a target folder is given
+        subfolder_id = folder_id or resolve_drive_folder(drive_service, current_channel().drive_folder_id, day_folder)
+        
+        # Check if the file already exists in this subfolder
+        query = (
+            f"name = {drive_query_literal(filename)} and {drive_query_literal(subfolder_id)} in parents "
+            "and trashed = false"
+        )
+        results = drive_service.files().list(q=query, spaces='drive', fields="files(id)").execute()
+        items = results.get('files', [])
+        if items:
+            logger.info(f"File {filename} already exists in Drive. Skipping upload.")
+            return items[0]['id']
+        
+        file_metadata = {'name': filename, 'parents': [subfolder_id]}
+        file_stream.seek(0)
+        from googleapiclient.http import MediaIoBaseUpload
+        media = MediaIoBaseUpload(file_stream, mimetype=mimetype, resumable=True)
+        
+        try:
+            created_file = drive_service.files().create(
+                body=file_metadata, media_body=media, fields='id'
+            ).execute()
+            file_id = created_file.get('id')
+            logger.info(f"Uploaded {filename} ({mimetype}) to Drive. File ID: {file_id}")
+            return file_id
+        except Exception as e:
+            logger.error(f"Error uploading {filename} to Drive: {e}")
+            return None
+
+def upload_image_to_drive(file_stream, filename, day_folder, folder_id=None):
+    """Upload a JPEG image; see upload_to_drive."""
+    return upload_to_drive(file_stream, filename, day_folder, 'image/jpeg', folder_id)
+
+def upload_video_to_drive(file_stream, filename, day_folder, folder_id=None):
+    """Upload an MP4 video; see upload_to_drive."""
+    return upload_to_drive(file_stream, filename, day_folder, 'video/mp4', folder_id)
+
+# ===================== Storage Backends =====================
+class DriveStorage(StorageBackend):
+    """Google Drive: one folder per logical folder under the current channel's Drive root (see DRIVE_FOLDER_LAYOUT)."""
+
+    name = "drive"
+
+    def ensure_folder(self, folder):
+        with get_drive_service() as drive_service:
+            return resolve_drive_folder(drive_service, current_channel().drive_folder_id, folder)
+
+    def put(self, content, filename, folder, mimetype):
+        return upload_to_drive(io.BytesIO(content), filename, folder, mimetype)
+
+def create_storage():
+    """Build the storage backend selected by STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "local":
+        return LocalCASStorage(LOCAL_STORAGE_DIR)
+    if STORAGE_BACKEND == "s3":
+        return S3Storage(
+            S3_BUCKET, endpoint_url=S3_ENDPOINT_URL, prefix=S3_PREFIX,
+            access_key=os.getenv("S3_ACCESS_KEY_ID"), secret_key=os.getenv("S3_SECRET_ACCESS_KEY"),
+            region=os.getenv("S3_REGION")
+        )
+    return DriveStorage()
+
+storage = create_storage()
+
+def storage_folder(folder):
+    """
+    Storage folder for the current channel. Drive separates channels by root folder;
+    the local and S3 backends put other channels' folders under '<channel>/'.
+    """
+    channel = current_channel()
+    if storage.name == "drive" or channel.name == DEFAULT_CHANNEL:
+        return folder
+    return f"{channel.name}/{folder}"
+
+# ===================== Circuit Breakers & Pending Uploads =====================
+# While storage or LINE content downloads are failing or slow, media is kept under OUTPUT_DIR
+# and journaled in PENDING_UPLOADS_FILE; drain_pending_uploads() uploads it once storage recovers.
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "60"))
+storage_breaker = CircuitBreaker(
+    storage.name, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS, failure_rate=BREAKER_FAILURE_RATE,
+    slow_call_seconds=float(os.getenv("STORAGE_SLOW_CALL_SECONDS", "30")), open_seconds=BREAKER_OPEN_SECONDS,
+    logger=logger
+)
+line_content_breaker = CircuitBreaker(
+    "line-content", window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS, failure_rate=BREAKER_FAILURE_RATE,
+    slow_call_seconds=float(os.getenv("LINE_SLOW_CALL_SECONDS", "10")), open_seconds=BREAKER_OPEN_SECONDS,
+    logger=logger
+)
+
+PENDING_UPLOADS_FILE = os.path.join(OUTPUT_DIR, "pending_uploads.jsonl")
+PENDING_DRAINING_FILE = PENDING_UPLOADS_FILE + ".draining"
+PENDING_DRAIN_INTERVAL = float(os.getenv("PENDING_DRAIN_INTERVAL", "30"))
+_pending_lock = threading.Lock()
+
+LINE_CONTENT_CHUNK = 1024 * 1024
+
+def fetch_message_content(message_id):
+    """Download media content from LINE through line_content_breaker. Returns bytes or None."""
+    permit = line_content_breaker.allow_request()
+    if not permit:
+        logger.warning(f"LINE content circuit open, deferring messageId={message_id}")
+        return None
+    started = time.perf_counter()
     try:
-        created_file = drive_service.files().create(
-            body=file_metadata, media_body=media, fields='id'
-        ).execute()
-        file_id = created_file.get('id')
-        logger.info(f"Uploaded image to Drive. File ID: {file_id}")
-        return file_id
+        # Collected in one growing buffer: the SDK's .content joins a list of chunks, so a
+        # video would briefly be held twice. getvalue() hands the buffer over without a copy.
+        buffer = io.BytesIO()
+        for chunk in line_api().get_message_content(message_id).iter_content(LINE_CONTENT_CHUNK):
+            buffer.write(chunk)
+        content = buffer.getvalue()
     except Exception as e:
-        logger.error(f"Error uploading image to Drive: {e}")
+        logger.error(f"Error fetching content for messageId={message_id}: {e}")
+        content = None
+    line_content_breaker.record(content is not None, time.perf_counter() - started, permit)
+    return content
+
+def upload_with_breaker(content, filename, folder, mimetype):
+    """Store through storage_breaker. Returns the backend's key, or None if skipped or failed."""
+    permit = storage_breaker.allow_request()
+    if not permit:
         return None
+    started = time.perf_counter()
+    try:
+        file_id = storage.put(content, filename, storage_folder(folder), mimetype)
+    except Exception as e:
+        logger.error(f"Error storing {filename} in {storage.name}: {e}")
+        file_id = None
+    storage_breaker.record(file_id is not None, time.perf_counter() - started, permit)
+    return file_id
 
-def upload_video_to_drive(file_stream, filename, day_folder):
+def add_pending_upload(entry):
+    """Journal a media item that still needs to reach Drive."""
+    with _pending_lock:
+        with open(PENDING_UPLOADS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    logger.info(f"Marked {entry['filename']} for later upload")
+
+def store_media(message_id, dt, user_id, display_name, filename, mimetype, content, folder=None):
     """
-    Upload a video (from a BytesIO stream) to Google Drive under a daily subfolder.
-    Duplicate checking is done based on the filename (which includes the LINE message ID).
+    Store media in the storage backend (under `folder`, default the day folder) and catalog it.
+    If storage is unavailable (or content is None because LINE could not be reached)
+    the item is saved locally and marked for later upload.
     """
-    SCOPES = ['https://www.googleapis.com/auth/drive.file']
-    credentials = get_google_credentials()
-    drive_service = build('drive', 'v3', credentials=credentials)
-    
-    # Get (or create) the daily subfolder (e.g., "2025-03-15")
-    subfolder_id = get_or_create_subfolder(drive_service, GOOGLE_DRIVE_FOLDER_ID, day_folder)
-    
-    # Check if the file already exists in this subfolder
-    query = f"name = '{filename}' and '{subfolder_id}' in parents and trashed = false"
-    results = drive_service.files().list(q=query, spaces='drive', fields="files(id)").execute()
-    items = results.get('files', [])
-    if items:
-        logger.info(f"File {filename} already exists in Drive. Skipping upload.")
-        return items[0]['id']
-    
-    file_metadata = {'name': filename, 'parents': [subfolder_id]}
-    file_stream.seek(0)
-    media = MediaIoBaseUpload(file_stream, mimetype='video/mp4', resumable=True)
-    
+    day_folder = dt.strftime("%Y-%m-%d")
+    if content is not None:
+        file_id = upload_with_breaker(content, filename, folder or day_folder, mimetype)
+        if file_id:
+            logger.info(f"{filename} stored in {storage.name} as: {file_id}")
+            record_media(message_id, dt, user_id, display_name, file_id, day_folder, content, mimetype)
+            return file_id
+        local_path = save_to_local(io.BytesIO(content), filename, get_daily_folder(dt))
+        logger.warning(f"{storage.name} unavailable, saved {filename} to {local_path}")
+    else:
+        local_path = None
+    add_pending_upload({
+        "message_id": message_id,
+        "timestamp": dt.timestamp(),
+        "user_id": user_id,
+        "display_name": display_name,
+        "filename": filename,
+        "mimetype": mimetype,
+        "folder": folder,
+        "local_path": local_path,
+        "channel": current_channel().name,
+    })
+    return None
+
+def _upload_pending_entry(entry):
+    """Try to finish one journaled item; returns True once it is in storage."""
+    if entry["local_path"]:
+        with open(entry["local_path"], "rb") as f:
+            content = f.read()
+    else:
+        content = fetch_message_content(entry["message_id"])
+        if content is None:
+            return False
+    dt = datetime.fromtimestamp(entry["timestamp"])
+    day_folder = dt.strftime("%Y-%m-%d")
+    file_id = upload_with_breaker(content, entry["filename"], entry.get("folder") or day_folder, entry["mimetype"])
+    if not file_id:
+        return False
+    record_media(entry["message_id"], dt, entry["user_id"], entry["display_name"],
+                 file_id, day_folder, content, entry["mimetype"])
+    if entry["local_path"]:
+        output_retention.mark_uploaded(entry["local_path"])
+    return True
+
+def drain_pending_uploads():
+    """
+    Upload everything in the pending journal. The journal is moved aside first so
+    handlers can keep appending; items that still fail are appended back.
+    """
+    with _pending_lock:
+        if not os.path.exists(PENDING_DRAINING_FILE):
+            if not os.path.exists(PENDING_UPLOADS_FILE):
+                return 0
+            os.replace(PENDING_UPLOADS_FILE, PENDING_DRAINING_FILE)
+        with open(PENDING_DRAINING_FILE, encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+    remaining = []
+    for entry in entries:
+        try:
+            with channel_context(channels.get(entry.get("channel"), current_channel())):
+                done = not storage_breaker.is_open() and _upload_pending_entry(entry)
+        except Exception as e:
+            logger.error(f"Error uploading pending {entry['filename']}: {e}")
+            done = False
+        if not done:
+            remaining.append(entry)
+    with _pending_lock:
+        with open(PENDING_UPLOADS_FILE, "a", encoding="utf-8") as f:
+            for entry in remaining:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.remove(PENDING_DRAINING_FILE)
+    uploaded = len(entries) - len(remaining)
+    if entries:
+        logger.info(f"Pending uploads: {uploaded} uploaded, {len(remaining)} still pending")
+    return uploaded
+
+def run_pending_upload_drain():
+    """Background loop that retries pending uploads while the storage circuit is not open."""
+    while True:
+        time.sleep(PENDING_DRAIN_INTERVAL)
+        if storage_breaker.is_open():
+            continue
+        try:
+            drain_pending_uploads()
+        except Exception as e:
+            logger.error(f"Error draining pending uploads: {e}")
+
+# ===================== Outbound Messages =====================
+# Replies go through `outbox`, which keeps each call within LINE's five-message limit and
+# its rate limits. Stored photos and videos are acknowledged per conversation once every
+# ACK_BATCH_WINDOW seconds ("已備份 12 張照片") instead of once per item. The ack is a reply
+# with the newest reply token. Pushes count against the monthly message quota, so an ack
+# whose token has expired is dropped unless ACK_PUSH_FALLBACK is set; it is then a push,
+# or one multicast shared by users due the same text. Media of replayed events (journals)
+# is not acknowledged: the previous process may already have done so.
+ACK_MEDIA = os.getenv("ACK_MEDIA", "true").lower() in ("1", "true", "yes")
+ACK_BATCH_WINDOW = float(os.getenv("ACK_BATCH_WINDOW", "5"))
+ACK_PUSH_FALLBACK = os.getenv("ACK_PUSH_FALLBACK", "false").lower() in ("1", "true", "yes")
+# Seconds a reply token is trusted after LINE sent the event (LINE allows about a minute)
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))
+# Calls per second allowed per endpoint (LINE's limits are 2,000 for reply/push, 200 for multicast)
+LINE_RATE_LIMITS = {
+    "reply": float(os.getenv("LINE_REPLY_RATE", "1000")),
+    "push": float(os.getenv("LINE_PUSH_RATE", "1000")),
+    "multicast": float(os.getenv("LINE_MULTICAST_RATE", "100")),
+}
+ACK_UNITS = (("image", "張照片"), ("video", "部影片"))
+
+def format_ack(counts):
+    return "已備份 " + "、".join(f"{counts[kind]} {unit}" for kind, unit in ACK_UNITS if counts[kind])
+
+outbox = Outbox(format_ack, window=ACK_BATCH_WINDOW, reply_token_ttl=REPLY_TOKEN_TTL, rates=LINE_RATE_LIMITS,
+                logger=logger, push_fallback=ACK_PUSH_FALLBACK)
+# True while a replayed event's handler runs (see _dispatch_event)
+_event_replayed = contextvars.ContextVar("event_replayed", default=False)
+
+def event_age(event):
+    """Seconds since LINE sent the event (its reply token was issued then)."""
+    return max(0.0, time.time() - event.timestamp / 1000) if getattr(event, "timestamp", None) else 0.0
+
+def send_reply(reply_token, *messages, to=None):
+    """
+    Reply on the current channel; messages beyond the first five are pushed to `to`.
+    Nothing is sent for an event queued past REPLY_TOKEN_TTL (its reply_token is None).
+    """
+    outbox.reply(line_api(), reply_token, messages, to=to)
+
+def acknowledge_media(event, kind):
+    """Queue a batched 已備份 acknowledgment for a stored photo or video."""
+    if not ACK_MEDIA or _event_replayed.get():
+        return
+    channel = current_channel()
+    source_id = get_source_id(event.source)
+    outbox.acknowledge((channel.name, source_id), channel.line_bot_api, source_id, event.reply_token, kind,
+                       token_age=event_age(event))
+
+# ===================== Album Mode =====================
+# (channel, source ID of a group, room or user) -> (album name, storage folder reference)
+# of the active album.
+# Loaded once by load_active_albums() and kept in sync by activate/deactivate_album,
+# so media handlers resolve the target folder without any DB or Drive call.
+active_album_cache = {}
+
+def get_source_id(source):
+    """Return the group, room or user ID that a LINE event came from."""
+    return getattr(source, "group_id", None) or getattr(source, "room_id", None) or source.user_id
+
+def load_active_albums():
+    """Fill active_album_cache (and drive_folder_cache) from the 'active_albums' table."""
     try:
-        created_file = drive_service.files().create(
-            body=file_metadata, media_body=media, fields='id'
-        ).execute()
-        file_id = created_file.get('id')
-        logger.info(f"Uploaded video to Drive. File ID: {file_id}")
-        return file_id
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT channel, source_id, album_name, drive_folder_id FROM active_albums;")
+                rows = cur.fetchall()
     except Exception as e:
-        logger.error(f"Error uploading video to Drive: {e}")
-        return None
+        logger.error(f"Error loading active albums: {e}")
+        return
+    for channel_name, source_id, album_name, folder_id in rows:
+        active_album_cache[(channel_name, source_id)] = (album_name, folder_id)
+        if storage.name == "drive" and channel_name in channels:
+            drive_folder_cache[(channels[channel_name].drive_folder_id, album_name)] = folder_id
+    logger.info(f"Loaded {len(rows)} active album(s)")
+
+def activate_album(source_id, full_album_name):
+    """
+    Make `full_album_name` the active album for a source of the current channel: prepare
+    its storage folder (a Drive folder for the Drive backend), persist the choice and
+    update the in-memory cache.
+    """
+    channel_name = current_channel().name
+    folder_id = storage.ensure_folder(storage_folder(full_album_name))
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO active_albums (channel, source_id, album_name, drive_folder_id)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (channel, source_id) DO UPDATE
+                SET album_name = EXCLUDED.album_name,
+                    drive_folder_id = EXCLUDED.drive_folder_id,
+                    updated_at = CURRENT_TIMESTAMP;
+            """, (channel_name, source_id, full_album_name, folder_id))
+    active_album_cache[(channel_name, source_id)] = (full_album_name, folder_id)
+    return folder_id
+
+def deactivate_album(source_id):
+    """End album mode for a source of the current channel; later media goes back to the day folders."""
+    channel_name = current_channel().name
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM active_albums WHERE channel = %s AND source_id = %s;",
+                        (channel_name, source_id))
+    return active_album_cache.pop((channel_name, source_id), None)
+
+def get_album_folder(source):
+    """Return the folder name of the source's active album, or None for day-folder mode."""
+    album = active_album_cache.get((current_channel().name, get_source_id(source)))
+    return album[0] if album else None
+
+def reply_create_album(event, album_date, album_name):
+    """Activate a new album for the event's source and confirm it to the user."""
+    full_album_name = f"{album_date}_{album_name}"
+    try:
+        activate_album(get_source_id(event.source), full_album_name)
+    except Exception as e:
+        logger.error(f"Error creating album {full_album_name}: {e}")
+        send_reply(event.reply_token, TextSendMessage(text="建立相簿時發生錯誤，請稍後再試"))
+        return
+    logger.info(f"User {event.source.user_id} created album: {full_album_name}")
+    send_reply(
+        event.reply_token,
+        TextSendMessage(text=f"相簿已建立：{full_album_name}\n之後的照片與影片將存到此相簿，輸入「結束相簿」可回到每日資料夾")
+    )
+
+# ===================== Memory Profiling =====================
+# Per handler, how far each event raised the process's peak RSS (ru_maxrss, the figure the
+# dyno's memory limit applies to). While tracemalloc runs (started from /debug/memory) the
+# Python-level allocation peak is recorded too; it is process-wide, so events running at
+# the same time on other lanes share it.
+EVENT_MEMORY_WARN_MB = float(os.getenv("EVENT_MEMORY_WARN_MB", "100"))
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "10"))
+# handler name -> [events, total RSS growth KB, max RSS growth KB, max traced peak bytes]
+event_memory = {}
+_event_memory_lock = threading.Lock()
+_memory_snapshot = None
+
+def peak_rss_kb():
+    """Peak resident set size of this process so far, in KB (0 where unsupported)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0
+
+@contextmanager
+def track_event_memory(name):
+    """Record the peak memory growth of the block under `name`."""
+    rss_before = peak_rss_kb()
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        growth_kb = peak_rss_kb() - rss_before
+        traced_peak = tracemalloc.get_traced_memory()[1] if tracing else 0
+        with _event_memory_lock:
+            stats = event_memory.setdefault(name, [0, 0, 0, 0])
+            stats[0] += 1
+            stats[1] += growth_kb
+            stats[2] = max(stats[2], growth_kb)
+            stats[3] = max(stats[3], traced_peak)
+        if growth_kb > EVENT_MEMORY_WARN_MB * 1024:
+            logger.warning(f"{name} raised peak RSS by {growth_kb / 1024:.1f} MB (now {peak_rss_kb() / 1024:.1f} MB)")
+
+def get_event_memory_stats():
+    with _event_memory_lock:
+        return {
+            "peak_rss_mb": round(peak_rss_kb() / 1024, 1),
+            "handlers": {
+                name: {
+                    "events": count,
+                    "avg_rss_growth_mb": round(total / count / 1024, 2),
+                    "max_rss_growth_mb": round(peak / 1024, 2),
+                    "max_traced_peak_mb": round(traced / (1024 * 1024), 2),
+                }
+                for name, (count, total, peak, traced) in event_memory.items()
+            },
+        }
+
+def memory_snapshot_report(top=25, group_by="lineno"):
+    """
+    Take a tracemalloc snapshot and return its top allocations plus the change since the
+    previous snapshot. Starts tracing on first use (nothing to report until the next call).
+    """
+    global _memory_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        _memory_snapshot = None
+        return {"tracing": "started"}
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    report = {
+        "traced_current_mb": round(current / (1024 * 1024), 2),
+        "traced_peak_mb": round(peak / (1024 * 1024), 2),
+        "top": [str(stat) for stat in snapshot.statistics(group_by)[:top]],
+    }
+    if _memory_snapshot is not None:
+        report["diff"] = [str(stat) for stat in snapshot.compare_to(_memory_snapshot, group_by)[:top]]
+    _memory_snapshot = snapshot
+    return report
+
+# ===================== Redelivery Fast Path =====================
+# LINE flags retried webhooks with deliveryContext.isRedelivery. Their webhookEventId is
+# checked against the durable 'processed_events' log before any download or upload, so a
+# redelivery storm after an outage (or a restart) does not re-process every media item.
+# Webhooks fed back from this process's own journals (replays) are checked the same way,
+# since a previous process may have handled part of them, but are counted separately so
+# the redelivery figures only reflect what LINE resent.
+PROCESSED_EVENTS_RETENTION_DAYS = int(os.getenv("PROCESSED_EVENTS_RETENTION_DAYS", "7"))
+RECENT_EVENT_IDS_MAX = 10000
+
+processed_event_writer = BatchedWriter("processed_events", """
+    INSERT INTO processed_events (webhook_event_id, processed_at)
+    VALUES %s
+    ON CONFLICT (webhook_event_id) DO NOTHING
+""")
+# Recently processed IDs, covering rows still buffered in processed_event_writer
+recent_event_ids = OrderedDict()
+redelivery_stats = {"redelivered": 0, "skipped": 0, "replayed": 0, "replay_skipped": 0}
+_redelivery_lock = threading.Lock()
+
+def is_event_processed(event_id):
+    """True if the webhook event was already handled (by this or an earlier process)."""
+    with _redelivery_lock:
+        if event_id in recent_event_ids:
+            return True
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1 FROM processed_events WHERE webhook_event_id = %s;", (event_id,))
+                return cur.fetchone() is not None
+    except Exception as e:
+        # Fail open: handling an event twice beats dropping it
+        logger.error(f"Error checking processed event {event_id}: {e}")
+        return False
+
+def skip_redelivery(event_id, replayed=False):
+    """Count a redelivered (or, with `replayed`, journal-replayed) event and decide whether it can be skipped."""
+    skip = bool(event_id) and is_event_processed(event_id)
+    counter, skipped_counter = ("replayed", "replay_skipped") if replayed else ("redelivered", "skipped")
+    with _redelivery_lock:
+        redelivery_stats[counter] += 1
+        if skip:
+            redelivery_stats[skipped_counter] += 1
+    return skip
+
+def mark_event_processed(event_id):
+    with _redelivery_lock:
+        recent_event_ids[event_id] = True
+        if len(recent_event_ids) > RECENT_EVENT_IDS_MAX:
+            recent_event_ids.popitem(last=False)
+    processed_event_writer.add((event_id, datetime.now()))
+
+def get_redelivery_stats():
+    with _redelivery_lock:
+        stats = dict(redelivery_stats)
+    redelivered, skipped = stats["redelivered"], stats["skipped"]
+    stats["skip_rate"] = round(skipped / redelivered, 3) if redelivered else 0.0
+    return stats
+
+def prune_processed_events(retention_days=PROCESSED_EVENTS_RETENTION_DAYS):
+    """Drop processed-event entries older than LINE could still redeliver."""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM processed_events WHERE processed_at < %s;",
+                (datetime.now() - timedelta(days=retention_days),)
+            )
+            logger.info(f"Pruned {cur.rowcount} processed event(s)")
 
 # ===================== Global Duplicate Tracking =====================
 # Use global sets to track processed message IDs for images and videos.
 processed_image_ids = set()
 processed_video_ids = set()
-# Global dictionary for video sequencing if needed.
-video_counters = {}
+
+# ===================== Media Sequence Counters =====================
+class PostgresSequenceCounter:
+    """
+    Per-minute sequence numbers kept in the 'media_sequences' table; the upsert is
+    atomic, so numbers stay unique across worker processes. Rows older than the
+    horizon are pruned at most once a minute.
+    """
+
+    def __init__(self, horizon_minutes=SEQUENCE_HORIZON_MINUTES):
+        self.horizon_minutes = horizon_minutes
+        self._last_prune = 0.0
+
+    def next(self, key, dt):
+        counter_key = "|".join(str(part) for part in key)
+        minute = dt.replace(second=0, microsecond=0)
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO media_sequences (counter_key, minute, seq) VALUES (%s, %s, 1)
+                    ON CONFLICT (counter_key, minute) DO UPDATE SET seq = media_sequences.seq + 1
+                    RETURNING seq;
+                """, (counter_key, minute))
+                seq = cur.fetchone()[0]
+                if time.monotonic() - self._last_prune > 60:
+                    self._last_prune = time.monotonic()
+                    cur.execute(
+                        "DELETE FROM media_sequences WHERE minute < %s - make_interval(mins => %s);",
+                        (minute, self.horizon_minutes)
+                    )
+        return seq
+
+def create_sequence_counter():
+    """Build the counter selected by SEQUENCE_COUNTER."""
+    if SEQUENCE_COUNTER == "sqlite":
+        return SQLiteSequenceCounter(SEQUENCE_COUNTER_SQLITE_PATH, SEQUENCE_HORIZON_MINUTES)
+    if SEQUENCE_COUNTER == "postgres":
+        return PostgresSequenceCounter(SEQUENCE_HORIZON_MINUTES)
+    return SlidingWindowCounter(SEQUENCE_HORIZON_MINUTES)
+
+# Video sequencing per (user, minute); old minutes are evicted after SEQUENCE_HORIZON_MINUTES.
+# Not part of media filenames: a redelivered or replayed event must produce the same
+# filename, since uploads are deduplicated by filename.
+video_counters = create_sequence_counter()
 
 # ===================== Flask App & Webhook Handlers =====================
 app = Flask(__name__)
 
 @app.route("/callback", methods=["POST"])
-def callback():
+@app.route("/callback/<channel_name>", methods=["POST"])
+def callback(channel_name=DEFAULT_CHANNEL):
+    channel = channels.get(channel_name)
+    if channel is None:
+        abort(404)
     signature = request.headers.get("X-Line-Signature")
     body = request.get_data(as_text=True)
     logger.info(f"Received LINE request, body: {body}")
+    if not lifecycle.accepting:
+        logger.warning("Shutting down, rejecting webhook")
+        abort(503)
     try:
-        handler.handle(body, signature)
+        events = channel.parser.parse(body, signature)
     except InvalidSignatureError:
-        logger.error("Signature validation failed")
+        logger.error(f"Signature validation failed for channel '{channel.name}'")
         abort(400)
+    if overflow_active(channel):
+        if not overflow_webhook(channel, body, signature):
+            logger.warning(f"Channel '{channel.name}' event queue and overflow journal full, rejecting webhook")
+            abort(503)
+        return "OK", 200
+    schedule_events(channel, body, signature, events)
     return "OK", 200
 
-# Load user mapping from the environment variable
-def load_user_mapping():
-    user_mapping_json = os.getenv("USER_MAPPING_JSON")
-    if not user_mapping_json:
-        raise Exception("USER_MAPPING_JSON environment variable is not set.")
-    return json.loads(user_mapping_json)
+# ===================== Event Scheduling =====================
+# Events are sharded by conversation (group, room or user ID) onto their channel's lanes:
+# each conversation's events run one at a time in arrival order, so its _msg.txt lines and
+# DB rows keep their order, while different conversations are handled in parallel.
+
+def dispatch_event(channel, event, replayed=False):
+    """
+    Run the handler registered for the event with on_event(), as WebhookHandler.handle() would.
+    `replayed` events (from a journal) may have been handled already, like redeliveries.
+    An event that waited on its lane (or in the overflow journal) past REPLY_TOKEN_TTL is
+    still handled, but its reply token is dropped: LINE would reject the reply.
+    """
+    with channel_context(channel):
+        _dispatch_event(event, replayed)
+
+def _dispatch_event(event, replayed):
+    func = find_event_handler(event)
+    if func is None:
+        logger.info(f"No handler for {type(event).__name__}")
+        return
+    event_id = getattr(event, "webhook_event_id", None)
+    redelivered = event.delivery_context is not None and event.delivery_context.is_redelivery
+    if redelivered or replayed:
+        if skip_redelivery(event_id, replayed=not redelivered):
+            logger.info(f"{'Redelivered' if redelivered else 'Replayed'} event {event_id} already processed, skipping.")
+            return
+    age = event_age(event)
+    if getattr(event, "reply_token", None) and age >= REPLY_TOKEN_TTL:
+        logger.info(f"Event {event_id} waited {age:.0f}s, its reply token has expired; not replying.")
+        event.reply_token = None
+    replayed_token = _event_replayed.set(replayed)
+    try:
+        with track_event_memory(func.__name__):
+            func(event)
+    finally:
+        _event_replayed.reset(replayed_token)
+    if event_id:
+        mark_event_processed(event_id)
+
+def schedule_events(channel, body, signature, events, replayed=False):
+    """Queue a webhook's events on their conversations' lanes; the body stays in flight until all are done."""
+    request_id = lifecycle.begin(body, signature, channel.name)
+    if not events:
+        lifecycle.end(request_id)
+        return
+    remaining = [len(events)]
+    lock = threading.Lock()
+
+    def on_done():
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            lifecycle.end(request_id)
+
+    for event in events:
+        channel.scheduler.submit(get_source_id(event.source), dispatch_event, channel, event, replayed,
+                                 on_done=on_done)
 
-# Load the mapping at the start of the application
-USER_MAPPING = load_user_mapping()
+# ===================== Backpressure =====================
+# Each channel's queued events are held between two watermarks, so a busy channel only
+# diverts its own webhooks. Once a channel's lanes hold EVENT_QUEUE_HIGH events, its new
+# webhooks are appended to its overflow journal instead of being queued, and keep going
+# there until the journal has been fed back in, which starts when its queue is down to
+# EVENT_QUEUE_LOW. If the journal is over OVERFLOW_MAX_BYTES (0 disables overflow), the
+# channel's webhooks get a 503 so LINE redelivers them later.
+EVENT_QUEUE_HIGH = int(os.getenv("EVENT_QUEUE_HIGH", "500"))
+EVENT_QUEUE_LOW = int(os.getenv("EVENT_QUEUE_LOW", "100"))
+OVERFLOW_MAX_BYTES = int(os.getenv("OVERFLOW_MAX_BYTES", str(100 * 1024 * 1024)))
+OVERFLOW_WEBHOOKS_FILE = os.path.join(OUTPUT_DIR, "overflow_webhooks.jsonl")
+OVERFLOW_DRAINING_FILE = OVERFLOW_WEBHOOKS_FILE + ".draining"
+OVERFLOW_POLL_INTERVAL = 0.5
+
+event_queue_gates = {
+    name: WatermarkGate(f"event-queue-{name}", EVENT_QUEUE_HIGH, EVENT_QUEUE_LOW, logger=logger)
+    for name in channels
+}
+overflow_stats = {name: {"overflowed": 0, "rejected": 0, "drained": 0} for name in channels}
+_overflow_lock = threading.Lock()
+_overflow_ready = {name: threading.Event() for name in channels}
+
+def overflow_files(channel):
+    """(journal, draining file) of a channel; the default channel keeps the original names."""
+    if channel.name == DEFAULT_CHANNEL:
+        return OVERFLOW_WEBHOOKS_FILE, OVERFLOW_DRAINING_FILE
+    journal = os.path.join(OUTPUT_DIR, f"overflow_webhooks-{channel.name}.jsonl")
+    return journal, journal + ".draining"
+
+def overflow_journal_bytes(channel):
+    return sum(os.path.getsize(path) for path in overflow_files(channel) if os.path.exists(path))
+
+def queued_events(channel):
+    """Events waiting on the channel's lanes."""
+    return sum(channel.scheduler.depths())
+
+def queue_overflowing(channel):
+    return event_queue_gates[channel.name].update(queued_events(channel))
+
+def overflow_active(channel):
+    """True while the channel's new webhooks must go to its journal (queue full or journal not yet fed back)."""
+    overflowing = queue_overflowing(channel)
+    return overflowing or any(os.path.exists(path) for path in overflow_files(channel))
+
+def overflow_webhook(channel, body, signature):
+    """Append a webhook to the channel's overflow journal; returns False if the journal is full."""
+    stats = overflow_stats[channel.name]
+    with _overflow_lock:
+        if overflow_journal_bytes(channel) >= OVERFLOW_MAX_BYTES:
+            stats["rejected"] += 1
+            return False
+        try:
+            _append_journal(overflow_files(channel)[0], {"body": body, "signature": signature, "channel": channel.name})
+        except OSError as e:
+            logger.error(f"Error writing overflow journal of channel '{channel.name}': {e}")
+            stats["rejected"] += 1
+            return False
+        stats["overflowed"] += 1
+    _overflow_ready[channel.name].set()
+    return True
+
+def drain_overflow(channel):
+    """
+    Feed the channel's journaled webhooks back to its lanes in arrival order, pausing
+    whenever its queue is back at the high watermark. The journal is moved aside first, so
+    webhooks arriving meanwhile append to a fresh one (and stay behind the ones being fed back).
+    """
+    journal, draining = overflow_files(channel)
+    with _overflow_lock:
+        if not os.path.exists(draining):
+            if not os.path.exists(journal):
+                return 0
+            os.replace(journal, draining)
+    drained = 0
+    with open(draining, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            while queue_overflowing(channel):
+                time.sleep(OVERFLOW_POLL_INTERVAL)
+            entry = json.loads(line)
+            try:
+                events = channel.parser.parse(entry["body"], entry["signature"])
+            except Exception as e:
+                logger.error(f"Error parsing overflowed webhook: {e}")
+                continue
+            # A previous process may have fed back part of this file before stopping
+            schedule_events(channel, entry["body"], entry["signature"], events, replayed=True)
+            drained += 1
+    with _overflow_lock:
+        os.remove(draining)
+        overflow_stats[channel.name]["drained"] += drained
+    logger.info(f"Fed {drained} overflowed webhook(s) back to channel '{channel.name}'")
+    return drained
+
+def run_overflow_drain(channel):
+    """Background loop: feed the channel's journal back once its queue is under the low watermark."""
+    while True:
+        _overflow_ready[channel.name].wait(OVERFLOW_POLL_INTERVAL * 10)
+        _overflow_ready[channel.name].clear()
+        while any(os.path.exists(path) for path in overflow_files(channel)):
+            if queue_overflowing(channel):
+                time.sleep(OVERFLOW_POLL_INTERVAL)
+                continue
+            try:
+                drain_overflow(channel)
+            except Exception as e:
+                logger.error(f"Error draining overflow journal of channel '{channel.name}': {e}")
+                time.sleep(OVERFLOW_POLL_INTERVAL * 10)
+
+def get_backpressure_stats():
+    stats = {}
+    for name, channel in channels.items():
+        stats[name] = event_queue_gates[name].stats()
+        stats[name]["queued"] = queued_events(channel)
+        stats[name]["overflow_journal_bytes"] = overflow_journal_bytes(channel)
+        with _overflow_lock:
+            stats[name].update(overflow_stats[name])
+    return stats
+
+# Set by warm_up() once credentials, today's folder, the DB pool and the profile cache are ready
+ready_event = threading.Event()
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """Liveness: the process is up and serving requests."""
+    return "OK", 200
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """Readiness: warm-up has finished."""
+    if not ready_event.is_set():
+        return "WARMING UP", 503
+    return "READY", 200
+
+def require_admin():
+    """Abort unless the request carries 'Authorization: Bearer <ADMIN_TOKEN>'."""
+    if not ADMIN_TOKEN:
+        abort(404)
+    if request.headers.get("Authorization") != f"Bearer {ADMIN_TOKEN}":
+        abort(403)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Runtime metrics as JSON (admin only)."""
+    require_admin()
+    return {
+        "event_lanes": {name: channel.scheduler.stats() for name, channel in channels.items()},
+        "line_http": line_http_client.stats(),
+        "redelivery": get_redelivery_stats(),
+        "event_memory": get_event_memory_stats(),
+        "backpressure": get_backpressure_stats(),
+        "media_cache": media_cache.stats(),
+        "output_retention": output_retention.stats(),
+        "user_directory": user_directory.stats(),
+        "outbox": outbox.stats(),
+    }
+
+@app.route("/debug/memory", methods=["GET", "DELETE"])
+def debug_memory():
+    """
+    tracemalloc snapshots (admin only). The first GET starts tracing; each later GET
+    returns the top allocations and the diff against the previous GET. DELETE stops
+    tracing. Query parameters: top (default 25), group_by (lineno | filename | traceback).
+    """
+    global _memory_snapshot
+    require_admin()
+    if request.method == "DELETE":
+        tracemalloc.stop()
+        _memory_snapshot = None
+        return {"tracing": "stopped"}
+    group_by = request.args.get("group_by", "lineno")
+    if group_by not in ("lineno", "filename", "traceback"):
+        abort(400)
+    return memory_snapshot_report(request.args.get("top", 25, type=int), group_by)
+
+@app.route("/export", methods=["GET"])
+def export():
+    """
+    Stream one channel's chat history. Query parameters: channel (default 'default'),
+    start, end (YYYY-MM-DD, end exclusive), user_id, format (ndjson | csv | daily).
+    """
+    require_admin()
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in EXPORT_FORMATS:
+        abort(400)
+    channel_name = request.args.get("channel", DEFAULT_CHANNEL)
+    if channel_name not in channels:
+        abort(404)
+    try:
+        start = datetime.strptime(request.args["start"], "%Y-%m-%d") if request.args.get("start") else None
+        end = datetime.strptime(request.args["end"], "%Y-%m-%d") if request.args.get("end") else None
+    except ValueError:
+        abort(400)
+    rows = iter_messages(start, end, request.args.get("user_id"), channel=channel_name)
+    mimetypes = {"ndjson": "application/x-ndjson", "csv": "text/csv", "daily": "text/plain"}
+    return Response(
+        stream_with_context(format_messages(rows, fmt)),
+        content_type=f"{mimetypes[fmt]}; charset=utf-8"
+    )
+
+# ===================== Media Retrieval =====================
+# /media/<message_id> serves stored media. Everything cataloged by record_media is also put in
+# a size-bounded disk LRU cache (MEDIA_CACHE_MAX_MB, 0 disables), so recently ingested media is
+# sent straight from disk with send_file (sendfile under gunicorn, Range and If-None-Match
+# handled by Werkzeug). Misses are streamed from Drive (passing Range through) and a full
+# download is added to the cache. The ETag is the content's SHA-256.
+MEDIA_CACHE_DIR = os.path.join(OUTPUT_DIR, "media_cache")
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_MB", "1024")) * 1024 * 1024
+MEDIA_MAX_AGE = int(os.getenv("MEDIA_MAX_AGE", "3600"))
+MEDIA_LOOKUP_SIZE = 10000
+MEDIA_STREAM_CHUNK = 256 * 1024
+DRIVE_DOWNLOAD_URL = "https://www.googleapis.com/drive/v3/files/{}?alt=media"
+
+media_cache = DiskLRUCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES, logger=logger)
+# message_id -> (content_hash, mime_type, storage key) of recently cataloged media, which
+# may still be waiting in media_writer's buffer
+recent_media = OrderedDict()
+_recent_media_lock = threading.Lock()
+_drive_download_session = None
+
+def remember_media(message_id, content_hash, mime_type, file_id):
+    with _recent_media_lock:
+        recent_media[message_id] = (content_hash, mime_type, file_id)
+        recent_media.move_to_end(message_id)
+        while len(recent_media) > MEDIA_LOOKUP_SIZE:
+            recent_media.popitem(last=False)
+
+def lookup_media(message_id):
+    """(content_hash, mime_type, storage key) of a cataloged media item, or None."""
+    with _recent_media_lock:
+        if message_id in recent_media:
+            return recent_media[message_id]
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT content_hash, mime_type, drive_file_id FROM media WHERE message_id = %s;",
+                        (message_id,))
+            row = cur.fetchone()
+    return tuple(row) if row else None
+
+def get_drive_download_session():
+    """requests session authorized with the Drive credentials, for streamed downloads."""
+    global _drive_download_session
+    if _drive_download_session is None:
+        from google.auth.transport.requests import AuthorizedSession
+        _drive_download_session = AuthorizedSession(get_google_credentials())
+    return _drive_download_session
+
+def stream_drive_media(file_id, content_hash, mime_type):
+    """Stream a Drive file to the client; a complete 200 download is also added to media_cache."""
+    range_header = request.headers.get("Range")
+    upstream = get_drive_download_session().get(
+        DRIVE_DOWNLOAD_URL.format(file_id), headers={"Range": range_header} if range_header else {},
+        stream=True, timeout=DRIVE_HTTP_TIMEOUT
+    )
+    if upstream.status_code not in (200, 206):
+        logger.error(f"Drive returned {upstream.status_code} for file {file_id}")
+        upstream.close()
+        abort(416 if upstream.status_code == 416 else 502)
+    fill_cache = upstream.status_code == 200 and MEDIA_CACHE_MAX_BYTES > 0
+
+    def generate():
+        fd, tmp_path = media_cache.temp_file() if fill_cache else (None, None)
+        sink = os.fdopen(fd, "wb") if fd is not None else None
+        digest = hashlib.sha256()
+        complete = False
+        try:
+            for chunk in upstream.iter_content(MEDIA_STREAM_CHUNK):
+                if sink:
+                    sink.write(chunk)
+                    digest.update(chunk)
+                yield chunk
+            complete = True
+        finally:
+            upstream.close()
+            if sink:
+                sink.close()
+                if complete and digest.hexdigest() == content_hash:
+                    media_cache.put_file(content_hash, tmp_path)
+                else:
+                    os.remove(tmp_path)
+
+    headers = {"ETag": f'"{content_hash}"', "Accept-Ranges": "bytes", "Cache-Control": f"max-age={MEDIA_MAX_AGE}"}
+    for name in ("Content-Length", "Content-Range"):
+        if name in upstream.headers:
+            headers[name] = upstream.headers[name]
+    return Response(generate(), status=upstream.status_code, headers=headers, mimetype=mime_type)
+
+@app.route("/media/<message_id>", methods=["GET"])
+def media(message_id):
+    """Stored media for a LINE message ID (admin only); see Media Retrieval above."""
+    require_admin()
+    try:
+        info = lookup_media(message_id)
+    except Exception as e:
+        logger.error(f"Error looking up media {message_id}: {e}")
+        abort(503)
+    if info is None:
+        abort(404)
+    content_hash, mime_type, file_id = info
+    path = media_cache.get(content_hash) if content_hash else None
+    if path is None and isinstance(storage, LocalCASStorage) and content_hash:
+        object_path = storage.object_path(content_hash)
+        path = object_path if os.path.exists(object_path) else None
+    if path:
+        return send_file(path, mimetype=mime_type, conditional=True, etag=content_hash, max_age=MEDIA_MAX_AGE)
+    if content_hash and request.if_none_match.contains(content_hash):
+        return Response(status=304, headers={"ETag": f'"{content_hash}"'})
+    if storage.name != "drive" or not file_id:
+        abort(404)
+    return stream_drive_media(file_id, content_hash, mime_type)
+
+# ===================== User Directory =====================
+def connect_db():
+    """A new connection outside the pool (the user directory listener holds its own)."""
+    import psycopg2
+    return psycopg2.connect(host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD)
+
+def create_user_directory():
+    """Build the user directory selected by USER_DIRECTORY (started from __main__)."""
+    if USER_DIRECTORY == "postgres":
+        return PostgresUserDirectory(connect_db, logger=logger)
+    return JsonFileUserDirectory(USER_DIRECTORY_FILE, DEFAULT_CHANNEL, USER_DIRECTORY_POLL_INTERVAL, logger=logger)
+
+user_directory = create_user_directory()
 
 def get_display_name(user_id):
-    """Get the display name for a given user_id from the mapping."""
-    return USER_MAPPING.get(user_id, "Unknown")
+    """
+    Display name for a user of the current channel: the user directory, then the channel's
+    static mapping, then the cached LINE profile.
+    """
+    channel = current_channel()
+    return (user_directory.get(channel.name, user_id) or channel.user_mapping.get(user_id)
+            or profile_cache.get(user_id, "Unknown"))
 
-@handler.add(MessageEvent, message=TextMessage)
+# user_id -> display name used in media filenames; primed from the user mappings at warm-up,
+# otherwise filled from LINE profiles on first sight.
+profile_cache = {}
+
+def get_profile_name(user_id):
+    """Return the user's display name, fetching the LINE profile only on a cache miss."""
+    name = user_directory.get(current_channel().name, user_id)
+    if name:
+        return name
+    if user_id in profile_cache:
+        return profile_cache[user_id]
+    try:
+        display_name = line_api().get_profile(user_id).display_name
+    except LineBotApiError as e:
+        logger.error(f"Error fetching profile for user {user_id}: {e}")
+        return "Unknown"
+    profile_cache[user_id] = display_name
+    return display_name
+
+@on_event(MessageEvent, message=TextMessage)
 def handle_text_message(event):
     text = event.message.text.strip()
     user_id = event.source.user_id
@@ -272,7 +1905,7 @@ def handle_text_message(event):
         reply_text = ("請輸入相簿資料，格式：\n"
                       "建立相簿: YYYY-MM-DD, 相簿名稱\n"
                       "例如：建立相簿: 2023-03-12, 我的假期")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+        send_reply(event.reply_token, TextSendMessage(text=reply_text))
         return
     if text.startswith("建立相簿:"):
         details = text[len("建立相簿:"):].strip()
@@ -283,20 +1916,48 @@ def handle_text_message(event):
             try:
                 datetime.strptime(date_part, "%Y-%m-%d")
             except ValueError:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="日期格式不正確，請使用 YYYY-MM-DD 格式"))
+                send_reply(event.reply_token, TextSendMessage(text="日期格式不正確，請使用 YYYY-MM-DD 格式"))
+                return
+            # The album name becomes a folder name in every storage backend
+            if not album_name or "/" in album_name or "\\" in album_name:
+                send_reply(event.reply_token, TextSendMessage(text="相簿名稱不可空白，也不可包含 / 或 \\"))
                 return
-            full_album_name = f"{date_part}_{album_name}"
-            reply_text = f"相簿已建立：{full_album_name}"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-            logger.info(f"User {user_id} created album: {full_album_name}")
+            reply_create_album(event, date_part, album_name)
         else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請使用正確格式，範例：建立相簿: 2023-03-12, 我的假期"))
+            send_reply(event.reply_token, TextSendMessage(text="請使用正確格式，範例：建立相簿: 2023-03-12, 我的假期"))
+        return
+    if text == "結束相簿":
+        try:
+            album = deactivate_album(get_source_id(event.source))
+        except Exception as e:
+            logger.error(f"Error ending album for user {user_id}: {e}")
+            send_reply(event.reply_token, TextSendMessage(text="結束相簿時發生錯誤，請稍後再試"))
+            return
+        reply_text = f"相簿已結束：{album[0]}" if album else "目前沒有使用中的相簿"
+        send_reply(event.reply_token, TextSendMessage(text=reply_text))
+        return
+    
+    if text.startswith("搜尋:") or text.startswith("搜尋："):
+        keyword = text[len("搜尋:"):].strip()
+        if not keyword:
+            send_reply(event.reply_token, TextSendMessage(text="請使用正確格式，範例：搜尋: 關鍵字"))
+            return
+        logger.info(f"User {user_id} searched for: {keyword}")
+        reply_search_page(event.reply_token, user_id, keyword)
+        return
+    if text == "統計":
+        reply_stats(event.reply_token)
+        return
+    if text == "下一頁" and (current_channel().name, user_id) in search_cursors:
+        keyword, last_created_at, last_id = search_cursors[(current_channel().name, user_id)]
+        reply_search_page(event.reply_token, user_id, keyword, (last_created_at, last_id))
         return
     
     append_text_message(dt, display_name, text)
     insert_text_message_to_db(dt, user_id, display_name, text)
+    record_stat(user_id, dt, "text")
 
-@handler.add(MessageEvent, message=ImageMessage)
+@on_event(MessageEvent, message=ImageMessage)
 def handle_image_message(event):
     # Check duplicate using message ID
     if event.message.id in processed_image_ids:
@@ -304,34 +1965,28 @@ def handle_image_message(event):
         return
     processed_image_ids.add(event.message.id)
     
-    message_content = line_bot_api.get_message_content(event.message.id)
+    content = fetch_message_content(event.message.id)
     user_id = event.source.user_id
     dt = datetime.fromtimestamp(event.timestamp / 1000)
     
-    try:
-        profile = line_bot_api.get_profile(user_id)
-        display_name = sanitize_filename(profile.display_name)
-    except LineBotApiError as e:
-        display_name = "Unknown"
-        logger.error(f"Error fetching profile for user {user_id}: {e}")
+    display_name = sanitize_filename(get_profile_name(user_id))
+    record_stat(user_id, dt, "image")
     
     date_str = dt.strftime("%Y%m%d")
     time_str = dt.strftime("%H%M")
     # Filename includes message ID for uniqueness
     filename = f"{display_name}_{date_str}_{time_str}_{event.message.id}.jpg"
-    file_stream = io.BytesIO(message_content.content)
     
-    # Use daily subfolder (e.g., "2025-03-15")
-    day_folder = dt.strftime("%Y-%m-%d")
-    file_id = upload_image_to_drive(file_stream, filename, day_folder)
-    if file_id:
-        logger.info(f"Image uploaded to Drive with File ID: {file_id}")
-    else:
-        logger.error("Failed to upload image to Drive.")
+    # Use the active album's folder, otherwise the daily subfolder (e.g., "2025-03-15")
+    file_id = store_media(event.message.id, dt, user_id, display_name, filename, 'image/jpeg',
+                          content, get_album_folder(event.source))
+    if not file_id:
+        logger.error("Failed to upload image to Drive; kept for later upload.")
+        return
+    acknowledge_media(event, "image")
 
-@handler.add(MessageEvent, message=VideoMessage)
+@on_event(MessageEvent, message=VideoMessage)
 def handle_video_message(event):
-    global video_counters
     user_id = event.source.user_id
     message_id = event.message.id
     if message_id in processed_video_ids:
@@ -339,120 +1994,616 @@ def handle_video_message(event):
         return
     processed_video_ids.add(message_id)
     
-    message_content = line_bot_api.get_message_content(message_id)
+    content = fetch_message_content(message_id)
     dt = datetime.fromtimestamp(event.timestamp / 1000)
     date_str = dt.strftime("%Y%m%d")
     time_str = dt.strftime("%H%M")
-    key = (user_id, date_str, time_str)
-    sequence = video_counters.get(key, 0) + 1
-    video_counters[key] = sequence
+    record_stat(user_id, dt, "video")
     
-    try:
-        profile = line_bot_api.get_profile(user_id)
-        display_name = sanitize_filename(profile.display_name)
-    except LineBotApiError as e:
-        display_name = "Unknown"
-        logger.error(f"Error fetching profile for user {user_id}: {e}")
+    display_name = sanitize_filename(get_profile_name(user_id))
     
     # Construct filename using message ID for uniqueness
     filename = f"{display_name}_{date_str}_{time_str}_{event.message.id}.mp4"
-    file_stream = io.BytesIO(message_content.content)
-    # Use daily subfolder (same as for images)
-    day_folder = dt.strftime("%Y-%m-%d")
-    file_id = upload_video_to_drive(file_stream, filename, day_folder)
-    if file_id:
-        logger.info(f"Video uploaded to Drive with File ID: {file_id}")
-    else:
-        logger.error("Failed to upload video to Drive.")
+    # Use the active album's folder, otherwise the daily subfolder (same as for images)
+    file_id = store_media(message_id, dt, user_id, display_name, filename, 'video/mp4',
+                          content, get_album_folder(event.source))
+    if not file_id:
+        logger.error("Failed to upload video to Drive; kept for later upload.")
+        return
+    acknowledge_media(event, "video")
 
-@handler.add(PostbackEvent)
+@on_event(PostbackEvent)
 def handle_postback(event):
     data = event.postback.data
     params = dict(item.split("=") for item in data.split("&"))
     if params.get("action") == "create_album":
         album_date = params.get("album_date", datetime.now().strftime("%Y-%m-%d"))
         album_name = params.get("album_name", "default")
-        full_album_name = f"{album_date}_{album_name}"
-        logger.info(f"User {event.source.user_id} created album: {full_album_name}")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"相簿已建立：{full_album_name}"))
+        reply_create_album(event, album_date, album_name)
+
+# Full Drive scope, as previously granted implicitly by the discovery document. Scoping the
+# credentials up front lets every client share this object (and its token).
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
+_google_credentials = None
 
-def upload_video_to_drive(file_stream, filename, day_folder):
-    """
-    Upload a video (from a BytesIO stream) to Google Drive under a daily subfolder.
-    Duplicate checking is done based on the filename.
-    """
-    SCOPES = ['https://www.googleapis.com/auth/drive.file']
-    credentials = get_google_credentials()
-    drive_service = build('drive', 'v3', credentials=credentials)
-    
-    # Get (or create) the daily subfolder
-    subfolder_id = get_or_create_subfolder(drive_service, GOOGLE_DRIVE_FOLDER_ID, day_folder)
-    
-    # Check for duplicate file in the subfolder
-    query = f"name = '{filename}' and '{subfolder_id}' in parents and trashed = false"
-    results = drive_service.files().list(q=query, spaces='drive', fields="files(id)").execute()
-    items = results.get('files', [])
-    if items:
-        logger.info(f"File {filename} already exists in Drive. Skipping upload.")
-        return items[0]['id']
-    
-    file_metadata = {'name': filename, 'parents': [subfolder_id]}
-    file_stream.seek(0)
-    media = MediaIoBaseUpload(file_stream, mimetype='video/mp4', resumable=True)
-    
-    try:
-        created_file = drive_service.files().create(
-            body=file_metadata, media_body=media, fields='id'
-        ).execute()
-        file_id = created_file.get('id')
-        logger.info(f"Uploaded video to Drive. File ID: {file_id}")
-        return file_id
-    except Exception as e:
-        logger.error(f"Error uploading video to Drive: {e}")
-        return None
-    
 def get_google_credentials():
+    # Shared by every Drive client, so the OAuth token is fetched and refreshed once
+    global _google_credentials
+    if _google_credentials is not None:
+        return _google_credentials
+    from google.oauth2 import service_account
     # Try to read from the environment variable first
     cred_json = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON")
     if cred_json:
         credentials_info = json.loads(cred_json)
-        return service_account.Credentials.from_service_account_info(credentials_info)
+        _google_credentials = service_account.Credentials.from_service_account_info(credentials_info, scopes=DRIVE_SCOPES)
     else:
         # Fallback to reading from a local file
-        return service_account.Credentials.from_service_account_file("C:\MyProjects\line-messaging-bot\keys\linebot-google-storage-key.json")
+        _google_credentials = service_account.Credentials.from_service_account_file(
+            "C:\MyProjects\line-messaging-bot\keys\linebot-google-storage-key.json", scopes=DRIVE_SCOPES
+        )
+    return _google_credentials
     
+# ===================== Schema Migrations =====================
+MIGRATION_LOCK_ID = 72100001
+BACKFILL_LOCK_ID = 72100002
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+MESSAGES_BACKFILL_BATCH = int(os.getenv("MESSAGES_BACKFILL_BATCH", "1000"))
+MESSAGES_BACKFILL_PAUSE = float(os.getenv("MESSAGES_BACKFILL_PAUSE", "0.1"))
+
+def month_start(dt):
+    """Return midnight on the first day of dt's month."""
+    return datetime(dt.year, dt.month, 1)
+
+def next_month(dt):
+    """Return the first day of the month after dt's month."""
+    return datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+
+def create_month_partition(cur, start):
+    """
+    Create the monthly 'messages' partition that starts at `start` (if missing).
+    Rows of that month already in 'messages_default' (written while the partition did not
+    exist, e.g. by the legacy backfill) would make PostgreSQL refuse the partition, so they
+    are moved into it in the same transaction. 'messages' is locked meanwhile.
+    """
+    end = next_month(start)
+    name = f"messages_y{start:%Y}m{start:%m}"
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (name,))
+    if cur.fetchone()[0]:
+        return
+    # Writes queue behind the lock, so give up (until the next maintenance run) rather
+    # than wait for a long export to finish
+    cur.execute("""
+        SET LOCAL lock_timeout = '5s';
+        LOCK TABLE messages IN ACCESS EXCLUSIVE MODE;
+        SET LOCAL lock_timeout TO DEFAULT;
+    """)
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (name,))
+    if cur.fetchone()[0]:
+        return
+    cur.execute("""
+        SELECT EXISTS (SELECT 1 FROM messages_default WHERE created_at >= %s AND created_at < %s);
+    """, (start, end))
+    moving = cur.fetchone()[0]
+    if moving:
+        # Generated columns (search_grams) are recomputed on the way back in
+        cur.execute("""
+            SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) FROM pg_attribute
+            WHERE attrelid = 'messages'::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = '';
+        """)
+        columns = cur.fetchone()[0]
+        cur.execute(f"""
+            CREATE TEMP TABLE messages_moving AS
+            SELECT {columns} FROM messages_default WHERE created_at >= %s AND created_at < %s;
+            DELETE FROM messages_default WHERE created_at >= %s AND created_at < %s;
+        """, (start, end, start, end))
+        logger.info(f"Moving {cur.rowcount} message(s) from messages_default to {name}")
+    cur.execute(f"""
+        CREATE TABLE {name}
+        PARTITION OF messages
+        FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}');
+    """)
+    if moving:
+        cur.execute(f"""
+            INSERT INTO messages ({columns}) SELECT {columns} FROM messages_moving;
+            DROP TABLE messages_moving;
+        """)
+
+def migrate_baseline(cur):
+    """messages (with search indexes) and media, as created before versioning existed."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            user_id VARCHAR(255) NOT NULL,
+            display_name VARCHAR(255),
+            message_text TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    # Full-text search: tsvector for space-delimited words, pg_trgm for CJK substrings
+    cur.execute("""
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (to_tsvector('simple', coalesce(message_text, ''))) STORED;
+        CREATE INDEX IF NOT EXISTS idx_messages_search_vector ON messages USING GIN (search_vector);
+        CREATE INDEX IF NOT EXISTS idx_messages_text_trgm ON messages USING GIN (message_text gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS idx_messages_created_at_id ON messages (created_at DESC, id DESC);
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS media (
+            id BIGSERIAL PRIMARY KEY,
+            message_id VARCHAR(64) NOT NULL,
+            user_id VARCHAR(255) NOT NULL,
+            display_name VARCHAR(255),
+            created_at TIMESTAMP NOT NULL,
+            drive_file_id VARCHAR(128),
+            day_folder VARCHAR(10),
+            size_bytes BIGINT,
+            mime_type VARCHAR(64),
+            content_hash CHAR(64)
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_media_message_id ON media (message_id);
+        CREATE INDEX IF NOT EXISTS idx_media_created_at ON media (created_at);
+        CREATE INDEX IF NOT EXISTS idx_media_user_created_at ON media (user_id, created_at);
+    """)
+
+def migrate_partition_messages(cur):
+    """
+    Swap 'messages' for a table range-partitioned by month on created_at.
+    The old table is kept as 'messages_legacy' and copied over in the background
+    by backfill_legacy_messages(), so the swap itself is instant.
+    """
+    cur.execute("""
+        ALTER TABLE messages RENAME TO messages_legacy;
+        ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+        ALTER SEQUENCE messages_id_seq AS BIGINT;
+        CREATE TABLE messages (
+            id BIGINT NOT NULL DEFAULT nextval('messages_id_seq'),
+            user_id VARCHAR(255) NOT NULL,
+            display_name VARCHAR(255),
+            message_text TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            search_vector tsvector
+                GENERATED ALWAYS AS (to_tsvector('simple', coalesce(message_text, ''))) STORED,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+        CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+        CREATE INDEX idx_messages_part_user_created_at ON messages (user_id, created_at);
+        CREATE INDEX idx_messages_part_created_at_id ON messages (created_at DESC, id DESC);
+        CREATE INDEX idx_messages_part_search_vector ON messages USING GIN (search_vector);
+        CREATE INDEX idx_messages_part_text_trgm ON messages USING GIN (message_text gin_trgm_ops);
+        CREATE TABLE IF NOT EXISTS backfill_progress (
+            name VARCHAR(64) PRIMARY KEY,
+            last_id BIGINT NOT NULL DEFAULT 0,
+            done BOOLEAN NOT NULL DEFAULT FALSE,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        INSERT INTO backfill_progress (name) VALUES ('messages');
+    """)
+    # Partitions for the legacy history, so the backfill does not land in the default partition
+    cur.execute("SELECT min(created_at) FROM messages_legacy;")
+    oldest = cur.fetchone()[0]
+    start = month_start(oldest or datetime.now())
+    while start <= datetime.now():
+        create_month_partition(cur, start)
+        start = next_month(start)
+
+def migrate_active_albums(cur):
+    """Durable album-mode state, one active album per group/room/user."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS active_albums (
+            source_id VARCHAR(255) PRIMARY KEY,
+            album_name VARCHAR(255) NOT NULL,
+            drive_folder_id VARCHAR(128) NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+def migrate_media_sequences(cur):
+    """Shared per-minute media sequence numbers (SEQUENCE_COUNTER=postgres)."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS media_sequences (
+            counter_key VARCHAR(255) NOT NULL,
+            minute TIMESTAMP NOT NULL,
+            seq INTEGER NOT NULL,
+            PRIMARY KEY (counter_key, minute)
+        );
+        CREATE INDEX IF NOT EXISTS idx_media_sequences_minute ON media_sequences (minute);
+    """)
+
+def migrate_processed_events(cur):
+    """Durable log of handled webhookEventIds, consulted for redelivered events."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS processed_events (
+            webhook_event_id VARCHAR(64) PRIMARY KEY,
+            processed_at TIMESTAMP NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_processed_events_processed_at ON processed_events (processed_at);
+    """)
+
+def migrate_message_stats(cur):
+    """Rollup counters for the 統計 command, seeded from the existing history (default channel)."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS message_stats (
+            channel VARCHAR(64) NOT NULL,
+            user_id VARCHAR(255) NOT NULL,
+            period CHAR(1) NOT NULL,
+            day DATE NOT NULL,
+            kind VARCHAR(8) NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (channel, user_id, period, day, kind)
+        );
+    """)
+    cur.execute("""
+        WITH events AS (
+            SELECT user_id, created_at::date AS day, 'text' AS kind FROM messages
+            UNION ALL
+            -- legacy rows the background backfill has not copied yet
+            SELECT user_id, coalesce(created_at, TIMESTAMP '1970-01-01')::date, 'text' FROM messages_legacy
+            WHERE id > (SELECT last_id FROM backfill_progress WHERE name = 'messages' AND NOT done)
+            UNION ALL
+            SELECT user_id, created_at::date, CASE WHEN mime_type LIKE 'video/%%' THEN 'video' ELSE 'image' END
+            FROM media
+        ), periods AS (
+            SELECT user_id, 'd' AS period, day, kind FROM events
+            UNION ALL
+            SELECT user_id, 'm', date_trunc('month', day)::date, kind FROM events
+            UNION ALL
+            SELECT user_id, 'a', %s, kind FROM events
+        )
+        INSERT INTO message_stats (channel, user_id, period, day, kind, count)
+        SELECT %s, user_id, period, day, kind, count(*) FROM periods
+        GROUP BY user_id, period, day, kind
+        ON CONFLICT DO NOTHING;
+    """, (STATS_ALL_TIME, DEFAULT_CHANNEL))
+
+def migrate_user_directory(cur):
+    """Display names for USER_DIRECTORY=postgres; changes are announced with NOTIFY user_directory."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_directory (
+            channel VARCHAR(64) NOT NULL,
+            user_id VARCHAR(255) NOT NULL,
+            display_name VARCHAR(255) NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (channel, user_id)
+        );
+        CREATE OR REPLACE FUNCTION notify_user_directory() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('user_directory', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS user_directory_changed ON user_directory;
+        CREATE TRIGGER user_directory_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON user_directory
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_user_directory();
+    """)
+
+def migrate_channel_columns(cur):
+    """
+    Record the channel of every message, media item and active album. Existing rows
+    predate multi-channel hosting and belong to the default channel.
+    """
+    cur.execute("""
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS channel VARCHAR(64) NOT NULL DEFAULT %(default)s;
+        CREATE INDEX IF NOT EXISTS idx_messages_channel_created_at_id ON messages (channel, created_at DESC, id DESC);
+        ALTER TABLE media ADD COLUMN IF NOT EXISTS channel VARCHAR(64) NOT NULL DEFAULT %(default)s;
+        ALTER TABLE active_albums ADD COLUMN IF NOT EXISTS channel VARCHAR(64) NOT NULL DEFAULT %(default)s;
+        ALTER TABLE active_albums DROP CONSTRAINT IF EXISTS active_albums_pkey;
+        ALTER TABLE active_albums ADD PRIMARY KEY (channel, source_id);
+    """, {"default": DEFAULT_CHANNEL})
+
+def migrate_bigram_search(cur):
+    """
+    Replace the 'simple' tsvector and pg_trgm indexes used by search_messages() with one
+    GIN index over each message's characters and character pairs (see text_bigrams()).
+    Adding the stored column rewrites 'messages' once.
+    """
+    cur.execute(r"""
+        CREATE OR REPLACE FUNCTION text_bigrams(value text) RETURNS tsvector
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT coalesce(array_to_tsvector(array_agg(DISTINCT gram)), ''::tsvector)
+            FROM (SELECT lower(value) AS t) s,
+                 LATERAL generate_series(1, length(t)) AS i,
+                 LATERAL (VALUES (substr(t, i, 1)), (substr(t, i, 2))) AS g(gram)
+            WHERE gram <> '' AND gram !~ '\s'
+        $$;
+        -- The pairs of each whitespace-separated part of a keyword (a 1-character part
+        -- stands for itself), ANDed: every message containing the keyword matches
+        CREATE OR REPLACE FUNCTION text_bigram_query(value text) RETURNS tsquery
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT string_agg('''' || replace(replace(gram, '\', '\\'), '''', '''''') || '''', ' & ')::tsquery
+            FROM (
+                SELECT DISTINCT gram
+                FROM regexp_split_to_table(lower(value), '\s+') AS part,
+                     LATERAL generate_series(1, greatest(length(part) - 1, 1)) AS i,
+                     LATERAL (SELECT substr(part, i, 2) AS gram) g
+                WHERE part <> ''
+            ) grams
+        $$;
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_grams tsvector
+            GENERATED ALWAYS AS (text_bigrams(message_text)) STORED;
+        CREATE INDEX IF NOT EXISTS idx_messages_search_grams ON messages USING GIN (search_grams);
+        DROP INDEX IF EXISTS idx_messages_part_text_trgm;
+        ALTER TABLE messages DROP COLUMN IF EXISTS search_vector;
+    """)
+
+# (version, description, function(cur)); append only, never renumber.
+MIGRATIONS = [
+    (1, "baseline messages/media tables", migrate_baseline),
+    (2, "monthly range partitioning of messages", migrate_partition_messages),
+    (3, "active album per source", migrate_active_albums),
+    (4, "shared media sequence counters", migrate_media_sequences),
+    (5, "processed webhook event log", migrate_processed_events),
+    (6, "message count rollups", migrate_message_stats),
+    (7, "user directory with change notifications", migrate_user_directory),
+    (8, "channel column on messages, media and active albums", migrate_channel_columns),
+    (9, "character-pair search index on messages", migrate_bigram_search),
+]
+
+def apply_migrations(cur):
+    """Apply every migration newer than the recorded schema version."""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cur.execute("SELECT coalesce(max(version), 0) FROM schema_migrations;")
+    current = cur.fetchone()[0]
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info(f"Applying migration {version}: {description}")
+        migrate(cur)
+        cur.execute(
+            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s);",
+            (version, description)
+        )
+
+def ensure_message_partitions(months_ahead=PARTITION_MONTHS_AHEAD):
+    """Create monthly partitions from the current month up to `months_ahead` months ahead."""
+    start = month_start(datetime.now())
+    for _ in range(months_ahead + 1):
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cur:
+                    create_month_partition(cur, start)
+        except Exception as e:
+            logger.error(f"Error creating partition for {start:%Y-%m}: {e}")
+        start = next_month(start)
+
+# Rows of 'messages_legacy' the backfill has not copied yet (none once it is done), and
+# their created_at as copied (NULLs predate the NOT NULL column)
+LEGACY_NOT_COPIED = "id > (SELECT last_id FROM backfill_progress WHERE name = 'messages' AND NOT done)"
+LEGACY_CREATED_AT = "coalesce(created_at, TIMESTAMP '1970-01-01')"
+_legacy_backfill_done = False
+
+def legacy_backfill_pending(cur):
+    """
+    True until the messages backfill has finished: reads of the default channel's history
+    must then include the LEGACY_NOT_COPIED rows. Once seen finished it is not asked again.
+    """
+    global _legacy_backfill_done
+    if not _legacy_backfill_done:
+        cur.execute("SELECT NOT done FROM backfill_progress WHERE name = 'messages';")
+        row = cur.fetchone()
+        _legacy_backfill_done = row is None or not row[0]
+    return not _legacy_backfill_done
+
+def backfill_legacy_messages(batch_size=MESSAGES_BACKFILL_BATCH, pause=MESSAGES_BACKFILL_PAUSE):
+    """
+    Copy rows from 'messages_legacy' into the partitioned 'messages' in id order,
+    one small transaction per batch, resuming from the checkpoint in backfill_progress.
+    Only one process runs it at a time (advisory lock).
+    """
+    copied = 0
+    while True:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_xact_lock(%s);", (BACKFILL_LOCK_ID,))
+                if not cur.fetchone()[0]:
+                    return
+                cur.execute("SELECT last_id, done FROM backfill_progress WHERE name = 'messages';")
+                row = cur.fetchone()
+                if row is None or row[1]:
+                    return
+                last_id = row[0]
+                cur.execute("""
+                    SELECT max(id) FROM (
+                        SELECT id FROM messages_legacy WHERE id > %s ORDER BY id LIMIT %s
+                    ) batch;
+                """, (last_id, batch_size))
+                batch_max = cur.fetchone()[0]
+                if batch_max is None:
+                    cur.execute("""
+                        UPDATE backfill_progress SET done = TRUE, updated_at = CURRENT_TIMESTAMP
+                        WHERE name = 'messages';
+                    """)
+                    logger.info(f"Messages backfill finished ({copied} row(s) copied by this process).")
+                    return
+                cur.execute("""
+                    INSERT INTO messages (id, user_id, display_name, message_text, created_at)
+                    SELECT id, user_id, display_name, message_text,
+                           coalesce(created_at, TIMESTAMP '1970-01-01')
+                    FROM messages_legacy
+                    WHERE id > %s AND id <= %s
+                    ON CONFLICT DO NOTHING;
+                """, (last_id, batch_max))
+                copied += cur.rowcount
+                cur.execute("""
+                    UPDATE backfill_progress SET last_id = %s, updated_at = CURRENT_TIMESTAMP
+                    WHERE name = 'messages';
+                """, (batch_max,))
+        time.sleep(pause)
+
+def run_db_maintenance():
+    """Background loop: finish any pending backfill, then keep future partitions created daily."""
+    try:
+        backfill_legacy_messages()
+    except Exception as e:
+        logger.error(f"Error backfilling legacy messages: {e}")
+    while True:
+        time.sleep(24 * 60 * 60)
+        ensure_message_partitions()
+        try:
+            prune_processed_events()
+        except Exception as e:
+            logger.error(f"Error pruning processed events: {e}")
+
 def init_db():
-    """檢查並建立資料表（若不存在的話）。"""
+    """檢查並建立資料表（若不存在的話），並套用尚未執行的 schema migrations。"""
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        cur = conn.cursor()
-        create_table_sql = """
-            CREATE TABLE IF NOT EXISTS messages (
-                id SERIAL PRIMARY KEY,
-                user_id VARCHAR(255) NOT NULL,
-                display_name VARCHAR(255),
-                message_text TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """
-        cur.execute(create_table_sql)
-        conn.commit()
-        logger.info("資料表 'messages' 已初始化（若不存在則已建立）。")
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                # Serialize migrations across workers starting at the same time
+                cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+                apply_migrations(cur)
+        ensure_message_partitions()
+        load_active_albums()
+        threading.Thread(target=run_db_maintenance, name="db-maintenance", daemon=True).start()
+        logger.info("資料表 'messages'、'media' 已初始化（schema migrations 已套用）。")
     except Exception as e:
         logger.error(f"初始化資料表時發生錯誤: {e}")
-    finally:
-        if 'cur' in locals():
-            cur.close()
-        if 'conn' in locals():
-            conn.close()
+
+# ===================== Lifecycle / Graceful Shutdown =====================
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("SHUTDOWN_GRACE_SECONDS", "20"))
+UNFINISHED_WEBHOOKS_FILE = os.path.join(OUTPUT_DIR, "unfinished_webhooks.jsonl")
+UNFLUSHED_ROWS_FILE = os.path.join(OUTPUT_DIR, "unflushed_rows.jsonl")
+
+class Lifecycle:
+    """
+    Tracks in-flight webhooks and drains them on SIGTERM: new webhooks are rejected,
+    in-flight ones get until the deadline to finish, buffered DB rows are flushed, and
+    whatever is left is journaled under OUTPUT_DIR for the next process to replay.
+    """
+
+    def __init__(self):
+        self.accepting = True
+        self._in_flight = {}
+        self._next_id = 0
+        self._cond = threading.Condition()
+
+    def begin(self, body, signature, channel=DEFAULT_CHANNEL):
+        """Register a webhook body as in flight; returns the ID to pass to end()."""
+        with self._cond:
+            self._next_id += 1
+            request_id = self._next_id
+            self._in_flight[request_id] = (body, signature, channel)
+        return request_id
+
+    def end(self, request_id):
+        with self._cond:
+            del self._in_flight[request_id]
+            self._cond.notify_all()
+
+    def wait_idle(self, timeout):
+        """Wait until no webhook is in flight; returns the (body, signature, channel) still running."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._in_flight and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return list(self._in_flight.values())
+
+    def shutdown(self, grace=SHUTDOWN_GRACE_SECONDS):
+        """Stop accepting webhooks, drain in-flight work, journal the rest, send pending acknowledgments."""
+        self.accepting = False
+        logger.info(f"Shutdown requested, draining in-flight webhooks (up to {grace}s)")
+        unfinished = self.wait_idle(grace)
+        for body, signature, channel in unfinished:
+            _append_journal(UNFINISHED_WEBHOOKS_FILE, {"body": body, "signature": signature, "channel": channel})
+        for name, writer in batched_writers.items():
+            for row in writer.flush():
+                _append_journal(UNFLUSHED_ROWS_FILE, {"writer": name, "row": row})
+        # Before logging.shutdown(), so failed sends can still be logged
+        try:
+            outbox.flush(everything=True)
+        except Exception as e:
+            logger.error(f"Error sending pending acknowledgments: {e}")
+        logger.info(f"Shutdown complete ({len(unfinished)} unfinished webhook(s) journaled)")
+        logging.shutdown()
+
+lifecycle = Lifecycle()
+
+def _append_journal(path, entry):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False, default=lambda o: o.isoformat()) + "\n")
+
+def _take_journal(path):
+    """Read and remove a JSON-lines journal; returns its entries."""
+    if not os.path.exists(path):
+        return []
+    taken = path + ".replaying"
+    os.replace(path, taken)
+    with open(taken, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    os.remove(taken)
+    return entries
+
+def replay_journals():
+    """Re-queue DB rows and re-run webhooks left unfinished by the previous process."""
+    for entry in _take_journal(UNFLUSHED_ROWS_FILE):
+        batched_writers[entry["writer"]].add(tuple(entry["row"]))
+    for entry in _take_journal(UNFINISHED_WEBHOOKS_FILE):
+        channel = channels.get(entry.get("channel", DEFAULT_CHANNEL))
+        try:
+            events = channel.parser.parse(entry["body"], entry["signature"])
+        except Exception as e:
+            logger.error(f"Error replaying journaled webhook for channel {entry.get('channel')}: {e}")
+            continue
+        schedule_events(channel, entry["body"], entry["signature"], events, replayed=True)
+
+def handle_sigterm(signum, frame):
+    # Runs on the main thread, which is also the server's accept loop, so no new
+    # connections are taken while in-flight requests finish on their own threads.
+    lifecycle.shutdown()
+    sys.exit(0)
+
+# ===================== Warm-up =====================
+WARMUP_RETRY_INTERVAL = float(os.getenv("WARMUP_RETRY_INTERVAL", "5"))
+
+def warm_up():
+    """
+    Pay the first-request costs up front: the media cache index, Drive OAuth token and
+    client (Drive backend), today's day folder, the DB pool's minimum connections and the
+    profile cache. Retries until every step succeeds, then marks the app ready.
+    """
+    from google.auth.transport.requests import Request as GoogleAuthRequest
+    try:
+        media_cache.load()
+    except OSError as e:
+        logger.error(f"Error loading media cache, starting it empty: {e}")
+    while True:
+        started = time.perf_counter()
+        try:
+            if storage.name == "drive":
+                get_google_credentials().refresh(GoogleAuthRequest())
+            for channel in channels.values():
+                with channel_context(channel):
+                    storage.ensure_folder(storage_folder(datetime.now().strftime("%Y-%m-%d")))
+                profile_cache.update(channel.user_mapping)
+            with get_db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1;")
+            break
+        except Exception as e:
+            logger.error(f"Warm-up failed, retrying in {WARMUP_RETRY_INTERVAL}s: {e}")
+            time.sleep(WARMUP_RETRY_INTERVAL)
+    ready_event.set()
+    logger.info(f"Warm-up finished in {time.perf_counter() - started:.2f}s; ready.")
 
 if __name__ == "__main__":
     init_db()
+    user_directory.start()
+    outbox.start()
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    threading.Thread(target=replay_journals, name="replay-journals", daemon=True).start()
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    threading.Thread(target=run_pending_upload_drain, name="pending-uploads", daemon=True).start()
+    for channel in channels.values():
+        threading.Thread(target=run_overflow_drain, args=(channel,), name=f"overflow-drain-{channel.name}",
+                         daemon=True).start()
+    threading.Thread(target=run_message_compaction, name="message-compaction", daemon=True).start()
+    threading.Thread(target=run_output_retention, name="output-retention", daemon=True).start()
     port = int(PORT)
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file
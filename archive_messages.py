@@ -0,0 +1,45 @@
+import argparse
+import sys
+from datetime import datetime
+
+from app import channels, DEFAULT_CHANNEL, compact_message_logs, message_archive
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact and query the archived daily _msg.txt logs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compact = subparsers.add_parser(
+        "compact", help="archive the _msg.txt of finished days",
+        description="Archive the _msg.txt of finished days and, unless --keep-source, remove them. "
+                    "Safe to re-run after an interrupted run: a file already archived is not "
+                    "archived again, only removed."
+    )
+    compact.add_argument("--before", type=lambda v: parse_date(v).strftime("%Y-%m-%d"),
+                         help="archive days before this date (YYYY-MM-DD, default: today)")
+    compact.add_argument("--keep-source", action="store_true", help="keep the _msg.txt files after archiving")
+
+    query = subparsers.add_parser("query", help="print archived messages")
+    query.add_argument("--channel", default=DEFAULT_CHANNEL, help=f"channel name (default: {DEFAULT_CHANNEL})")
+    query.add_argument("--user", help="only messages from this display name")
+    query.add_argument("--start", type=parse_date, help="first day to print (YYYY-MM-DD)")
+    query.add_argument("--end", type=parse_date, help="day after the last one to print (YYYY-MM-DD)")
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        count = compact_message_logs(args.before, keep_source=args.keep_source)
+        print(f"Archived {count} message(s)")
+        return
+
+    if args.channel not in channels:
+        parser.error(f"unknown channel '{args.channel}'")
+    archive = message_archive(channels[args.channel])
+    for dt, name, text in archive.query(args.user, args.start, args.end):
+        sys.stdout.write(f"{dt.strftime('%Y-%m-%d %H:%M')} | {name} | {text}\n")
+    total = sum(len(archive.load_index(month)["blocks"]) for month in archive.months())
+    print(f"Read {archive.blocks_read} of {total} block(s), {archive.bytes_read} bytes", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import argparse
+import mimetypes
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from app import (
+    OUTPUT_DIR, DAY_FOLDER_PATTERN, channels, logger, storage, channel_context, channel_output_dir,
+    storage_folder, get_drive_service, resolve_drive_folder, list_folder_files, output_retention
+)
+
+CHECKPOINT_FILE = os.path.join(OUTPUT_DIR, "backfill_checkpoint.json")
+# Uploaded files recorded between checkpoint writes (the file is also written after every day)
+CHECKPOINT_EVERY = 200
+
+class Checkpoint:
+    """
+    Remembers uploaded files and fully reconciled days across runs, so an interrupted
+    backfill resumes without re-listing finished days. Keys are paths relative to
+    OUTPUT_DIR ("2025-03-15", "channels/<name>/2025-03-15/<file>"). Written atomically
+    after every CHECKPOINT_EVERY uploads and by save().
+    """
+
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = path
+        self.uploaded = set()
+        self.completed_days = set()
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.uploaded = set(data.get("uploaded", []))
+            self.completed_days = set(data.get("completed_days", []))
+
+    def mark_uploaded(self, rel_path):
+        with self._lock:
+            self.uploaded.add(rel_path)
+            self._unsaved += 1
+            if self._unsaved >= CHECKPOINT_EVERY:
+                self._save()
+
+    def mark_day_complete(self, day):
+        with self._lock:
+            self.completed_days.add(day)
+            # Per-file entries of a completed day are no longer needed
+            self.uploaded = {p for p in self.uploaded if not p.startswith(day + "/")}
+            self._save()
+
+    def save(self):
+        with self._lock:
+            if self._unsaved:
+                self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"uploaded": sorted(self.uploaded), "completed_days": sorted(self.completed_days)}, f)
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
+
+def local_media_files(day_dir):
+    """Return {filename: path} of the image/video files in a local day folder."""
+    files = {}
+    for entry in os.scandir(day_dir):
+        mimetype, _ = mimetypes.guess_type(entry.name)
+        if entry.is_file() and mimetype and mimetype.split("/")[0] in ("image", "video"):
+            files[entry.name] = entry.path
+    return files
+
+def upload_file(path, filename, folder_id):
+    """Upload one local file (streamed from disk) into a Drive folder; returns its file ID."""
+    from googleapiclient.http import MediaFileUpload
+    mimetype, _ = mimetypes.guess_type(filename)
+    media = MediaFileUpload(path, mimetype=mimetype, resumable=True)
+    with get_drive_service() as drive_service:
+        created_file = drive_service.files().create(
+            body={'name': filename, 'parents': [folder_id]}, media_body=media, fields='id'
+        ).execute()
+    return created_file.get('id')
+
+def put_file(path, filename, folder):
+    """Store one local file in a non-Drive backend (whose put() overwrites or skips an existing copy)."""
+    mimetype, _ = mimetypes.guess_type(filename)
+    with open(path, "rb") as f:
+        return storage.put(f.read(), filename, folder, mimetype)
+
+def reconcile_day(channel, day, day_dir, dry_run):
+    """
+    Compare one local day folder of a channel with its Drive counterpart using a single
+    bulk listing. Returns (local files, {filename: path} missing from Drive, Drive folder ID).
+    Other backends cannot be listed, so every local file counts as missing there and is
+    stored again; the returned folder is then the backend's storage folder.
+    """
+    local_files = local_media_files(day_dir)
+    if storage.name != "drive":
+        with channel_context(channel):
+            return local_files, dict(local_files), storage_folder(day)
+    with get_drive_service() as drive_service:
+        folder_id = resolve_drive_folder(drive_service, channel.drive_folder_id, day, create=not dry_run)
+        remote_names = list_folder_files(drive_service, folder_id) if folder_id else {}
+    missing = {name: path for name, path in local_files.items() if name not in remote_names}
+    return local_files, missing, folder_id
+
+def day_folders(since=None):
+    """(channel, day, label, path of the day folder) of every local day folder, default channel first."""
+    folders = []
+    for channel in channels.values():
+        base = channel_output_dir(channel)
+        if not os.path.isdir(base):
+            continue
+        prefix = os.path.relpath(base, OUTPUT_DIR)
+        for day in sorted(os.listdir(base)):
+            if DAY_FOLDER_PATTERN.match(day) and os.path.isdir(os.path.join(base, day)) and (not since or day >= since):
+                label = day if prefix == "." else f"{prefix}/{day}"
+                folders.append((channel, day, label, os.path.join(base, day)))
+    return folders
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Upload local media under OUTPUT_DIR (every channel) that never reached the storage backend. "
+                    "With Drive each day folder is compared with a Drive listing; other backends are not "
+                    "listed, so every local file of an unfinished day is stored again."
+    )
+    parser.add_argument("--since", type=lambda v: datetime.strptime(v, "%Y-%m-%d").strftime("%Y-%m-%d"),
+                        help="only day folders on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be uploaded without uploading")
+    parser.add_argument("--workers", type=int, default=4, help="parallel uploads (default: 4)")
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint()
+    summary = {}
+    totals = {"files": 0, "bytes": 0, "failed": 0}
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for channel, day, label, day_dir in day_folders(args.since):
+            if label in checkpoint.completed_days:
+                summary[label] = {"local": "-", "in_drive": "-", "uploaded": 0, "failed": 0, "note": "checkpointed"}
+                continue
+            local_files, missing, folder = reconcile_day(channel, day, day_dir, args.dry_run)
+            missing = {name: path for name, path in missing.items() if f"{label}/{name}" not in checkpoint.uploaded}
+            day_summary = {"local": len(local_files), "in_drive": len(local_files) - len(missing),
+                           "uploaded": 0, "failed": 0, "note": ""}
+            summary[label] = day_summary
+            if args.dry_run:
+                day_summary["note"] = f"would upload {len(missing)}"
+                for name in sorted(missing):
+                    print(f"[dry-run] {label}/{name}")
+                continue
+            # Local copies confirmed in the backend may now be evicted by the app's retention manager
+            for name, path in local_files.items():
+                if name not in missing:
+                    output_retention.mark_uploaded(path)
+
+            upload = upload_file if storage.name == "drive" else put_file
+            futures = {executor.submit(upload, path, name, folder): (name, path)
+                       for name, path in missing.items()}
+            for future in as_completed(futures):
+                name, path = futures[future]
+                try:
+                    file_id = future.result()
+                except Exception as e:
+                    logger.error(f"Error uploading {label}/{name}: {e}")
+                    day_summary["failed"] += 1
+                    continue
+                checkpoint.mark_uploaded(f"{label}/{name}")
+                output_retention.mark_uploaded(path)
+                day_summary["uploaded"] += 1
+                totals["files"] += 1
+                totals["bytes"] += os.path.getsize(path)
+                logger.info(f"Uploaded {label}/{name} to {storage.name} ({file_id})")
+            totals["failed"] += day_summary["failed"]
+            # Today's folder may still receive local fallbacks, so it is never checkpointed as done
+            if not day_summary["failed"] and day < datetime.now().strftime("%Y-%m-%d"):
+                checkpoint.mark_day_complete(label)
+            else:
+                checkpoint.save()
+
+    elapsed = time.perf_counter() - started
+    width = max([12] + [len(label) + 2 for label in summary])
+    print(f"\n{'day':<{width}}{'local':>7}{'stored':>10}{'uploaded':>10}{'failed':>8}  note")
+    for label, s in summary.items():
+        print(f"{label:<{width}}{s['local']:>7}{s['in_drive']:>10}{s['uploaded']:>10}{s['failed']:>8}  {s['note']}")
+    mb = totals["bytes"] / (1024 * 1024)
+    print(f"\nUploaded {totals['files']} file(s), {mb:.1f} MB in {elapsed:.1f}s "
+          f"({totals['files'] / elapsed if elapsed else 0:.2f} files/s, {mb / elapsed if elapsed else 0:.2f} MB/s); "
+          f"{totals['failed']} failed")
+    if totals["failed"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
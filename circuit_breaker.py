@@ -0,0 +1,98 @@
+import time
+import logging
+import threading
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    """
+    Failure-rate and latency circuit breaker for calls to a remote service.
+
+    The outcome of the last `window` calls is kept. Once at least `min_calls` have been
+    seen and either the failure rate or the slow-call rate reaches its threshold, the
+    breaker opens and allow_request() returns False for `open_seconds`. After that a
+    single half-open probe is let through: success closes the breaker, failure re-opens it.
+    allow_request() returns a permit to hand back to record(); only the probe's permit
+    decides the half-open outcome, so a slow call that started while the breaker was
+    still closed cannot close or re-open it.
+
+    Usage:
+        permit = breaker.allow_request()
+        if permit:
+            started = time.perf_counter()
+            ok = do_call()
+            breaker.record(ok, time.perf_counter() - started, permit)
+    """
+
+    def __init__(self, name, window=20, min_calls=5, failure_rate=0.5,
+                 slow_call_seconds=10.0, slow_call_rate=0.5, open_seconds=60.0, logger=None):
+        self.name = name
+        self.logger = logger or logging.getLogger(__name__)
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self._results = deque(maxlen=window)  # (failed, slow) per call
+        self._opened_at = 0.0
+        self._probe = None  # permit of the half-open probe in flight
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """True while the breaker is open and not yet due for a half-open probe."""
+        with self._lock:
+            return self.state == OPEN and time.monotonic() - self._opened_at < self.open_seconds
+
+    def allow_request(self):
+        """Return a (truthy) permit if a call may be attempted now, else False."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self.state = HALF_OPEN
+                self.logger.info(f"Circuit '{self.name}' half-open, sending a probe")
+            if self._probe is not None:
+                return False
+            self._probe = object()
+            return self._probe
+
+    def record(self, success, elapsed, permit=True):
+        """Report the outcome and duration (seconds) of a call, with the permit allow_request() gave it."""
+        slow = elapsed >= self.slow_call_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if permit is not self._probe:
+                    # Not the probe: a call let through while the breaker was still closed
+                    return
+                self._probe = None
+                if success and not slow:
+                    self.state = CLOSED
+                    self._results.clear()
+                    self.logger.info(f"Circuit '{self.name}' closed, probe succeeded in {elapsed:.2f}s")
+                else:
+                    self._trip(f"probe failed (success={success}, {elapsed:.2f}s)")
+                return
+            if self.state == OPEN:
+                # A call that started before the breaker opened
+                return
+            self._results.append((not success, slow))
+            if len(self._results) < self.min_calls:
+                return
+            failures = sum(1 for failed, _ in self._results if failed) / len(self._results)
+            slow_calls = sum(1 for _, was_slow in self._results if was_slow) / len(self._results)
+            if failures >= self.failure_rate:
+                self._trip(f"failure rate {failures:.0%}")
+            elif slow_calls >= self.slow_call_rate:
+                self._trip(f"slow-call rate {slow_calls:.0%} (>= {self.slow_call_seconds}s)")
+
+    def _trip(self, reason):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._results.clear()
+        self.logger.warning(f"Circuit '{self.name}' opened: {reason}; retrying in {self.open_seconds}s")
@@ -0,0 +1,89 @@
+import time
+import sqlite3
+import threading
+
+class SlidingWindowCounter:
+    """
+    Per-minute sequence numbers (e.g. the n-th video a user sent in a given minute)
+    that only remembers the last `horizon_minutes` minutes.
+
+    Counts are grouped into one small dict per minute; when a newer minute is seen,
+    buckets older than the horizon are dropped, so memory stays bounded on a
+    long-running process.
+    """
+
+    def __init__(self, horizon_minutes=60):
+        self.horizon_minutes = horizon_minutes
+        self._buckets = {}  # minute number -> {key: count}
+        self._newest = None
+        self._lock = threading.Lock()
+
+    def next(self, key, dt):
+        """Increment and return the count for `key` in the minute containing `dt`."""
+        minute = int(dt.timestamp() // 60)
+        with self._lock:
+            if self._newest is None or minute > self._newest:
+                self._newest = minute
+                cutoff = minute - self.horizon_minutes
+                for old in [m for m in self._buckets if m < cutoff]:
+                    del self._buckets[old]
+            bucket = self._buckets.setdefault(minute, {})
+            bucket[key] = bucket.get(key, 0) + 1
+            return bucket[key]
+
+    def __len__(self):
+        """Number of (minute, key) entries currently held."""
+        with self._lock:
+            return sum(len(bucket) for bucket in self._buckets.values())
+
+class SQLiteSequenceCounter:
+    """
+    SlidingWindowCounter semantics backed by a SQLite file, so several worker
+    processes on the same host hand out unique sequence numbers.
+    Each increment is one IMMEDIATE transaction; rows older than the horizon are
+    pruned at most once a minute.
+    """
+
+    def __init__(self, path, horizon_minutes=60):
+        self.path = path
+        self.horizon_minutes = horizon_minutes
+        self._local = threading.local()
+        self._last_prune = 0.0
+        conn = self._connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sequences (
+                counter_key TEXT NOT NULL,
+                minute INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                PRIMARY KEY (counter_key, minute)
+            )
+        """)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def next(self, key, dt):
+        minute = int(dt.timestamp() // 60)
+        counter_key = "|".join(str(part) for part in key) if isinstance(key, tuple) else str(key)
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("""
+                INSERT INTO sequences (counter_key, minute, seq) VALUES (?, ?, 1)
+                ON CONFLICT (counter_key, minute) DO UPDATE SET seq = seq + 1
+            """, (counter_key, minute))
+            seq = conn.execute(
+                "SELECT seq FROM sequences WHERE counter_key = ? AND minute = ?", (counter_key, minute)
+            ).fetchone()[0]
+            if time.monotonic() - self._last_prune > 60:
+                self._last_prune = time.monotonic()
+                conn.execute("DELETE FROM sequences WHERE minute < ?", (minute - self.horizon_minutes,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return seq
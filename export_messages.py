@@ -0,0 +1,32 @@
+import argparse
+import sys
+from datetime import datetime
+
+from app import EXPORT_FORMATS, DEFAULT_CHANNEL, channels, iter_messages, format_messages
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d")
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream chat history from the messages table.")
+    parser.add_argument("--start", type=parse_date, help="first day to export (YYYY-MM-DD)")
+    parser.add_argument("--end", type=parse_date, help="day after the last one to export (YYYY-MM-DD)")
+    parser.add_argument("--user-id", help="only export messages from this LINE user ID")
+    parser.add_argument("--channel", default=DEFAULT_CHANNEL, help=f"channel name (default: {DEFAULT_CHANNEL})")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="ndjson")
+    parser.add_argument("--output", help="output file (default: stdout)")
+    args = parser.parse_args()
+    if args.channel not in channels:
+        parser.error(f"unknown channel '{args.channel}'")
+
+    out = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    try:
+        rows = iter_messages(args.start, args.end, args.user_id, channel=args.channel)
+        for chunk in format_messages(rows, args.format):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+if __name__ == "__main__":
+    main()
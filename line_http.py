@@ -0,0 +1,84 @@
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from linebot.http_client import HttpClient, RequestsHttpResponse
+
+class PooledHttpClient(HttpClient):
+    """
+    HttpClient for LineBotApi backed by one shared requests.Session, so connections to
+    api.line.me and api-data.line.me are kept alive and reused instead of being opened
+    per call as the SDK's default client does.
+
+    `timeout` may be a (connect, read) tuple; `pool_size` bounds the keep-alive
+    connections kept per host. Streamed responses (message content) hand their
+    connection back to the pool once the body has been read.
+
+    Usage:
+        LineBotApi(token, timeout=(3.05, 30), http_client=functools.partial(PooledHttpClient, pool_size=10))
+    """
+
+    def __init__(self, timeout=HttpClient.DEFAULT_TIMEOUT, pool_size=10):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._adapters = [adapter]
+        self._latency = {}  # kind -> [count, total seconds, max seconds]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _kind(url):
+        if "/content" in url:
+            return "content"
+        if "/profile" in url or "/member/" in url:
+            return "profile"
+        if "/message/" in url:
+            return "message"
+        return "other"
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        started = time.perf_counter()
+        response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+        # Time to response headers; for streamed content the body is read by the caller
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            stats = self._latency.setdefault(self._kind(url), [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request("GET", url, timeout, headers=headers, params=params, stream=stream)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, timeout, headers=headers, data=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, timeout, headers=headers, data=data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, timeout, headers=headers, data=data)
+
+    def stats(self):
+        """Requests sent, connections opened (reuse = the rest) and latency per kind of call."""
+        requests_sent = connections = 0
+        for adapter in self._adapters:
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    requests_sent += pool.num_requests
+                    connections += pool.num_connections
+        with self._lock:
+            latency = {
+                kind: {"count": count, "avg_ms": round(total / count * 1000, 1), "max_ms": round(peak * 1000, 1)}
+                for kind, (count, total, peak) in self._latency.items()
+            }
+        return {
+            "requests": requests_sent,
+            "connections_opened": connections,
+            "reuse_ratio": round(1 - connections / requests_sent, 3) if requests_sent else 0.0,
+            "latency": latency,
+        }
@@ -0,0 +1,145 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+class DiskLRUCache:
+    """
+    Size-bounded file cache on local disk, keyed by content hash.
+
+    Entries live at <root>/<key[:2]>/<key>; once the total size passes `max_bytes` the least
+    recently used entries are deleted. Recency is kept in memory and mirrored to each file's
+    mtime, so the order survives a restart: load() rebuilds the index from disk. Creating
+    the cache touches nothing on disk, so importing code that builds one stays cheap; until
+    load() has run, earlier entries are simply misses. Entries are files on disk so they
+    can be served with sendfile.
+
+    Usage:
+        cache = DiskLRUCache("output/media_cache", max_bytes=1024 ** 3)
+        cache.load()
+        cache.put(content_hash, content)
+        path = cache.get(content_hash)  # None on a miss
+    """
+
+    def __init__(self, root, max_bytes, logger=None):
+        # Absolute, since the paths handed out may be resolved from another working directory
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.logger = logger or logging.getLogger(__name__)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> size, least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def load(self, stale_temp_age=3600):
+        """
+        Index the entries already on disk (oldest first, behind any put since) and delete
+        temp files older than `stale_temp_age` seconds, left over from interrupted writes.
+        Younger ones may belong to a write still in progress, in this or another process.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        cutoff = time.time() - stale_temp_age
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                    if name.startswith("tmp"):
+                        if stat.st_mtime < cutoff:
+                            os.remove(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_mtime, name, stat.st_size))
+        with self._lock:
+            entries = OrderedDict((key, size) for _, key, size in sorted(found) if key not in self._entries)
+            self._size += sum(entries.values())
+            entries.update(self._entries)
+            self._entries = entries
+            self._evict()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """Path of the cached file for `key` (marked as recently used), or None."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            # Removed behind our back
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+            return None
+        return path
+
+    def put(self, key, content):
+        """Cache `content` (bytes) under `key`."""
+        if not self.max_bytes or len(content) > self.max_bytes:
+            return
+        fd, tmp_path = self._temp_file(key)
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        self._commit(key, tmp_path, len(content))
+
+    def put_file(self, key, src_path):
+        """Move the file at `src_path` into the cache under `key`."""
+        size = os.path.getsize(src_path)
+        if not self.max_bytes or size > self.max_bytes:
+            os.remove(src_path)
+            return
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        shutil.move(src_path, self.path(key))
+        self._commit(key, None, size)
+
+    def temp_file(self):
+        """A (fd, path) for a file being written that will be handed to put_file()."""
+        os.makedirs(self.root, exist_ok=True)
+        return tempfile.mkstemp(dir=self.root, prefix="tmp")
+
+    def _temp_file(self, key):
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        return tempfile.mkstemp(dir=os.path.dirname(self.path(key)), prefix="tmp")
+
+    def _commit(self, key, tmp_path, size):
+        if tmp_path:
+            os.replace(tmp_path, self.path(key))
+        with self._lock:
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except OSError as e:
+                self.logger.error(f"Error evicting {key} from media cache: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,105 @@
+import sys
+import time
+import argparse
+
+from app import (
+    GOOGLE_DRIVE_FOLDER_ID, DAY_FOLDER_PATTERN, logger,
+    get_drive_service, get_or_create_subfolder, find_subfolder, list_folder_files
+)
+
+# Moves flat <root>/YYYY-MM-DD day folders into the nested <root>/YYYY/MM/DD layout.
+# Deploy with DRIVE_FOLDER_LAYOUT=nested first, so new uploads already go to the nested
+# folders, then run:
+#   python migrate_drive_layout.py [--dry-run] [--batch-size 50]
+# A day folder is moved and renamed in place (its files keep their IDs). If the nested DD
+# folder already exists, the day's files are moved into it and the old folder is trashed.
+# Migrated folders leave the root, so an interrupted run simply continues on the next one.
+
+DRIVE_BATCH_LIMIT = 100  # requests per Drive batch HTTP request
+
+def run_batch(drive_service, requests):
+    """Send (label, request) pairs as one Drive batch request; returns the labels that failed."""
+    failed = []
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            label = requests[int(request_id)][0]
+            logger.error(f"Error migrating {label}: {exception}")
+            failed.append(label)
+
+    batch = drive_service.new_batch_http_request(callback=callback)
+    for index, (_, request) in enumerate(requests):
+        batch.add(request, request_id=str(index))
+    batch.execute()
+    return failed
+
+def plan_day(drive_service, root_id, day, folder_id):
+    """
+    Return the requests that put one flat day folder at YYYY/MM/DD: (moves, cleanup).
+    Cleanup (trashing a merged folder) must only run after its moves have succeeded.
+    """
+    year, month, dd = day.split("-")
+    month_id = get_or_create_subfolder(drive_service, get_or_create_subfolder(drive_service, root_id, year), month)
+    existing_id = find_subfolder(drive_service, month_id, dd)
+    if existing_id is None:
+        return [(day, drive_service.files().update(
+            fileId=folder_id, addParents=month_id, removeParents=root_id, body={"name": dd}, fields="id"
+        ))], []
+    # Already created by the nested layout (e.g. today's folder): merge into it
+    moves = [(f"{day}/{name}", drive_service.files().update(
+        fileId=file_id, addParents=existing_id, removeParents=folder_id, fields="id"
+    )) for name, file_id in list_folder_files(drive_service, folder_id).items()]
+    return moves, [(day, drive_service.files().update(fileId=folder_id, body={"trashed": True}, fields="id"))]
+
+def send(drive_service, requests, batch_size):
+    """Send requests in batches of batch_size; returns the labels that failed."""
+    failed = []
+    for start in range(0, len(requests), batch_size):
+        chunk = requests[start:start + batch_size]
+        errors = run_batch(drive_service, chunk)
+        print(f"batch of {len(chunk)} request(s): {len(errors)} failed")
+        failed.extend(errors)
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Move flat YYYY-MM-DD Drive day folders into YYYY/MM/DD.")
+    parser.add_argument("--root", default=GOOGLE_DRIVE_FOLDER_ID, help="Drive root folder (default: GOOGLE_DRIVE_FOLDER_ID)")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help=f"Drive requests per batch (default: 50, max: {DRIVE_BATCH_LIMIT})")
+    parser.add_argument("--dry-run", action="store_true", help="list the day folders that would be moved")
+    args = parser.parse_args()
+    batch_size = max(1, min(args.batch_size, DRIVE_BATCH_LIMIT))
+
+    started = time.perf_counter()
+    with get_drive_service() as drive_service:
+        days = sorted(
+            (name, file_id) for name, file_id in list_folder_files(drive_service, args.root).items()
+            if DAY_FOLDER_PATTERN.match(name)
+        )
+        print(f"{len(days)} flat day folder(s) under {args.root}")
+        if args.dry_run:
+            for day, _ in days:
+                year, month, dd = day.split("-")
+                print(f"[dry-run] {day} -> {year}/{month}/{dd}")
+            return
+
+        moves, cleanup, failed = [], [], []
+        for day, folder_id in days:
+            day_moves, day_cleanup = plan_day(drive_service, args.root, day, folder_id)
+            moves.extend(day_moves)
+            cleanup.extend(day_cleanup)
+            if len(moves) >= batch_size:
+                failed += send(drive_service, moves, batch_size)
+                moves = []
+        failed += send(drive_service, moves, batch_size)
+        # A merged folder is trashed only if none of its files failed to move
+        failed_days = {label.split("/")[0] for label in failed}
+        failed += send(drive_service, [c for c in cleanup if c[0] not in failed_days], batch_size)
+        moved = len({day for day, _ in days} - {label.split("/")[0] for label in failed})
+
+    print(f"Migrated {moved} day folder(s) in {time.perf_counter() - started:.1f}s; {len(failed)} request(s) failed")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import os
+import re
+import json
+import zlib
+import heapq
+import hashlib
+import logging
+import threading
+from datetime import datetime
+
+# A record line in a daily _msg.txt; lines that do not match continue the previous text
+RECORD_PATTERN = re.compile(r"^(\d{2}:\d{2}) \| (.*?) \| (.*)$")
+
+def parse_msg_file(path, day):
+    """Yield (datetime, display name, text) records from one day's _msg.txt."""
+    record = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            match = RECORD_PATTERN.match(line)
+            if match:
+                if record:
+                    yield record
+                time_str, name, text = match.groups()
+                record = (datetime.strptime(f"{day} {time_str}", "%Y-%m-%d %H:%M"), name, text)
+            elif record:
+                record = (record[0], record[1], record[2] + "\n" + line)
+    if record:
+        yield record
+
+class MessageArchive:
+    """
+    Compressed, block-indexed archive of the daily _msg.txt logs.
+
+    Each month is one append-only file <YYYY-MM>.blocks of independently zlib-compressed
+    blocks, plus a sidecar <YYYY-MM>.idx.json listing every block's user, time range, byte
+    offset and length. A block holds one user's records from one day (split every
+    `block_records` records), so a query by user and/or time range reads the small index
+    and then seeks straight to the matching blocks. The index also keeps the SHA-256 of
+    every source file archived, so archiving the same file twice adds nothing.
+
+    Usage:
+        archive = MessageArchive("output/archive")
+        archive.compact_day("2025-03-15", "output/2025-03-15/2025-03-15_msg.txt")
+        for dt, name, text in archive.query(user="Joyce", start=datetime(2025, 3, 1)):
+            ...
+    """
+
+    def __init__(self, archive_dir, block_records=500, logger=None):
+        self.archive_dir = archive_dir
+        self.block_records = block_records
+        self.logger = logger or logging.getLogger(__name__)
+        self.blocks_read = 0
+        self.bytes_read = 0
+        self._lock = threading.Lock()
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def _paths(self, month):
+        base = os.path.join(self.archive_dir, month)
+        return base + ".blocks", base + ".idx.json"
+
+    def load_index(self, month):
+        _, index_path = self._paths(month)
+        if not os.path.exists(index_path):
+            return {"size": 0, "days": [], "blocks": [], "sources": {}}
+        with open(index_path, encoding="utf-8") as f:
+            index = json.load(f)
+        index.setdefault("sources", {})
+        return index
+
+    def months(self):
+        return sorted(name[:-len(".idx.json")] for name in os.listdir(self.archive_dir) if name.endswith(".idx.json"))
+
+    def is_compacted(self, day):
+        return day in self.load_index(day[:7])["days"]
+
+    def compact_day(self, day, path):
+        """
+        Append one day's records to its month archive; returns the number of records.
+        A file with the same content as one already archived for the day is skipped (0),
+        so a run that stopped between archiving a file and removing it can simply be
+        repeated. A different file for the same day (lines that arrived after the day's
+        file was compacted and removed) is appended; callers keeping the source, whose
+        file only grows, should check is_compacted() first.
+        """
+        month = day[:7]
+        blocks_path, index_path = self._paths(month)
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        source_hash = digest.hexdigest()
+        with self._lock:
+            index = self.load_index(month)
+            if source_hash in index["sources"].get(day, []):
+                self.logger.info(f"{path} is already archived in {blocks_path}, skipping")
+                return 0
+            by_user = {}
+            for record in parse_msg_file(path, day):
+                by_user.setdefault(record[1], []).append(record)
+            count = 0
+            with open(blocks_path, "ab") as f:
+                # Drop bytes from a run that stopped before its index was written
+                f.truncate(index["size"])
+                f.seek(index["size"])
+                for user, records in by_user.items():
+                    for start in range(0, len(records), self.block_records):
+                        chunk = records[start:start + self.block_records]
+                        payload = "\n".join(
+                            json.dumps([dt.strftime("%Y-%m-%d %H:%M"), name, text], ensure_ascii=False)
+                            for dt, name, text in chunk
+                        )
+                        data = zlib.compress(payload.encode("utf-8"), 6)
+                        index["blocks"].append({
+                            "user": user,
+                            "start": chunk[0][0].strftime("%Y-%m-%d %H:%M"),
+                            "end": chunk[-1][0].strftime("%Y-%m-%d %H:%M"),
+                            "offset": index["size"],
+                            "length": len(data),
+                            "count": len(chunk),
+                        })
+                        f.write(data)
+                        index["size"] += len(data)
+                        count += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            if day not in index["days"]:
+                index["days"].append(day)
+            index["sources"].setdefault(day, []).append(source_hash)
+            tmp_path = index_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(index, f, ensure_ascii=False)
+            os.replace(tmp_path, index_path)
+        self.logger.info(f"Archived {count} message(s) from {day} into {blocks_path}")
+        return count
+
+    def _read_block(self, f, block):
+        f.seek(block["offset"])
+        data = f.read(block["length"])
+        self.blocks_read += 1
+        self.bytes_read += len(data)
+        for line in zlib.decompress(data).decode("utf-8").split("\n"):
+            when, name, text = json.loads(line)
+            yield datetime.strptime(when, "%Y-%m-%d %H:%M"), name, text
+
+    def query(self, user=None, start=None, end=None):
+        """
+        Yield (datetime, name, text) in time order for `user` (all users if None) with
+        start <= time < end. Only blocks whose index entry matches are read.
+        """
+        start_key = start.strftime("%Y-%m-%d %H:%M") if start else None
+        end_key = end.strftime("%Y-%m-%d %H:%M") if end else None
+        for month in self.months():
+            if (start_key and month < start_key[:7]) or (end_key and month > end_key[:7]):
+                continue
+            blocks = [
+                block for block in self.load_index(month)["blocks"]
+                if (user is None or block["user"] == user)
+                and (start_key is None or block["end"] >= start_key)
+                and (end_key is None or block["start"] < end_key)
+            ]
+            if not blocks:
+                continue
+            blocks_path, _ = self._paths(month)
+            with open(blocks_path, "rb") as f:
+                streams = []
+                # Blocks are per user and day: merge them back into one time-ordered stream
+                for seq, block in enumerate(blocks):
+                    streams.append([(dt, seq, i, name, text)
+                                    for i, (dt, name, text) in enumerate(self._read_block(f, block))])
+                for dt, _, _, name, text in heapq.merge(*streams):
+                    if (start is None or dt >= start) and (end is None or dt < end):
+                        yield dt, name, text
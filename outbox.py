@@ -0,0 +1,200 @@
+import time
+import logging
+import threading
+from collections import Counter
+
+# LINE accepts at most this many messages per reply, push or multicast call
+MAX_MESSAGES_PER_CALL = 5
+# and at most this many recipients per multicast
+MAX_MULTICAST_RECIPIENTS = 500
+
+class RateLimiter:
+    """Token bucket: acquire() blocks until a call is allowed (`rate` calls/second, bursts up to `burst`)."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class Outbox:
+    """
+    Outbound LINE messages, batched to save API calls.
+
+    reply() sends a command's messages in as few calls as LINE allows: the first five in
+    the reply, any others pushed five at a time. acknowledge() does not send anything
+    itself: acknowledgments for the same key (e.g. a conversation) are counted for
+    `window` seconds and then sent as one message, by reply with the newest reply token
+    while it is still fresh. Otherwise the acknowledgment is dropped, unless
+    `push_fallback` is set: pushes count against the monthly message quota, so they are
+    opt-in. Pushed acknowledgments for users due the same text on the same API share one
+    multicast. Every call goes through a per-endpoint RateLimiter and is retried after a 429.
+
+    Usage:
+        outbox = Outbox(format_ack=lambda counts: f"已備份 {counts['image']} 張照片")
+        outbox.start()
+        outbox.reply(api, reply_token, [TextSendMessage(text="...")])
+        outbox.acknowledge(("default", group_id), api, group_id, reply_token, "image")
+    """
+
+    def __init__(self, format_ack, window=5.0, reply_token_ttl=50.0, rates=None, retries=3, logger=None,
+                 push_fallback=False):
+        self.format_ack = format_ack
+        self.window = window
+        self.reply_token_ttl = reply_token_ttl
+        self.push_fallback = push_fallback
+        self.retries = retries
+        self.logger = logger or logging.getLogger(__name__)
+        rates = rates or {}
+        self._limiters = {endpoint: RateLimiter(rates.get(endpoint, default))
+                          for endpoint, default in (("reply", 1000), ("push", 1000), ("multicast", 100))}
+        self._pending = {}  # key -> batch dict, see acknowledge()
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def _call(self, endpoint, fn, *args):
+        from linebot.exceptions import LineBotApiError
+        for attempt in range(self.retries + 1):
+            self._limiters[endpoint].acquire()
+            try:
+                result = fn(*args)
+            except LineBotApiError as e:
+                if e.status_code != 429 or attempt == self.retries:
+                    self._count("failed_calls")
+                    raise
+                self._count("rate_limited")
+                time.sleep(2 ** attempt)
+                continue
+            self._count(f"{endpoint}_calls")
+            return result
+
+    def reply(self, api, reply_token, messages, to=None):
+        """
+        Reply with up to five messages; the rest are pushed to `to` (dropped if not given).
+        Without a reply token (it expired while the event was queued) nothing is sent.
+        """
+        messages = list(messages)
+        if not reply_token:
+            self._count("replies_expired")
+            self.logger.warning(f"Dropping {len(messages)} message(s): the reply token has expired")
+            return
+        self._count("reply_messages", len(messages))
+        self._call("reply", api.reply_message, reply_token, messages[:MAX_MESSAGES_PER_CALL])
+        rest = messages[MAX_MESSAGES_PER_CALL:]
+        if rest and to is None:
+            self.logger.warning(f"Dropping {len(rest)} message(s) beyond the reply limit: no recipient to push to")
+            return
+        for start in range(0, len(rest), MAX_MESSAGES_PER_CALL):
+            self._call("push", api.push_message, to, rest[start:start + MAX_MESSAGES_PER_CALL])
+
+    def acknowledge(self, key, api, to, reply_token, kind, count=1, token_age=0.0):
+        """
+        Count `count` items of `kind` towards the acknowledgment batched under `key`.
+        `token_age` is how many seconds ago LINE issued `reply_token` (the event's age).
+        """
+        now = time.monotonic()
+        with self._lock:
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = self._pending[key] = {"api": api, "to": to, "counts": Counter(), "events": 0,
+                                              "reply_token": None, "token_at": None, "due": now + self.window}
+            batch["counts"][kind] += count
+            batch["events"] += 1
+            # Keep the most recently issued token
+            issued_at = now - token_age
+            if reply_token and (batch["token_at"] is None or issued_at >= batch["token_at"]):
+                batch["reply_token"], batch["token_at"] = reply_token, issued_at
+            self._stats["acks"] += 1
+
+    def flush(self, everything=False):
+        """Send the batches whose window has ended (all of them if `everything`); returns API calls made."""
+        now = time.monotonic()
+        with self._lock:
+            due = [key for key, batch in self._pending.items() if everything or batch["due"] <= now]
+            batches = [self._pending.pop(key) for key in due]
+        calls = 0
+        pushes = {}  # (id(api), text) -> (api, [batch]): users here can share one multicast
+        for batch in batches:
+            text = self.format_ack(batch["counts"])
+            token_fresh = batch["reply_token"] and now - batch["token_at"] < self.reply_token_ttl
+            if token_fresh:
+                try:
+                    self._call("reply", batch["api"].reply_message, batch["reply_token"], [self._message(text)])
+                    calls += 1
+                    self._count("acks_sent", batch["events"])
+                    continue
+                except Exception as e:
+                    calls += 1
+                    self.logger.warning(f"Acknowledgment reply failed: {e}")
+            if not self.push_fallback:
+                self._count("acks_dropped", batch["events"])
+                continue
+            pushes.setdefault((id(batch["api"]), text), (batch["api"], []))[1].append(batch)
+        for (_, text), (api, group) in pushes.items():
+            # Multicast only reaches users; groups and rooms get a push each
+            users = [batch for batch in group if batch["to"].startswith("U")]
+            for batch in group:
+                if not batch["to"].startswith("U"):
+                    calls += self._push(api, text, [batch])
+            for start in range(0, len(users), MAX_MULTICAST_RECIPIENTS):
+                calls += self._push(api, text, users[start:start + MAX_MULTICAST_RECIPIENTS])
+        return calls
+
+    def _push(self, api, text, batches):
+        try:
+            if len(batches) == 1:
+                self._call("push", api.push_message, batches[0]["to"], [self._message(text)])
+            else:
+                self._call("multicast", api.multicast, [batch["to"] for batch in batches], [self._message(text)])
+        except Exception as e:
+            self.logger.error(f"Error sending acknowledgment to {len(batches)} recipient(s): {e}")
+            return 1
+        self._count("acks_sent", sum(batch["events"] for batch in batches))
+        return 1
+
+    @staticmethod
+    def _message(text):
+        from linebot.models import TextSendMessage
+        return TextSendMessage(text=text)
+
+    def run(self):
+        """Background loop: flush due batches."""
+        while True:
+            time.sleep(min(self.window, 1.0))
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(f"Error flushing acknowledgments: {e}")
+
+    def start(self):
+        threading.Thread(target=self.run, name="outbox", daemon=True).start()
+
+    def stats(self):
+        """Calls made and how many batching saved against one call per acknowledgment or message."""
+        with self._lock:
+            pending = sum(batch["events"] for batch in self._pending.values())
+            stats = dict(self._stats)
+        # Every attempt is a call, including failed ones and retries after a 429
+        calls = sum(count for name, count in stats.items() if name.endswith("_calls")) + stats.get("rate_limited", 0)
+        unbatched = stats.get("acks_sent", 0) + stats.get("reply_messages", 0)
+        stats["pending_acks"] = pending
+        stats["api_calls"] = calls
+        stats["api_calls_saved"] = max(0, unbatched - calls)
+        return stats
@@ -0,0 +1,145 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+
+class RetentionManager:
+    """
+    Keeps the files under a directory within a total-size and age budget.
+
+    Files are registered with track() when written and marked with mark_uploaded() once a
+    remote copy is confirmed; only marked files are ever deleted, oldest first. Usage is kept
+    in a SQLite index next to the files, so enforcing the budget never walks the tree, and
+    each enforce() call deletes at most `batch_size` files. A budget of 0 disables that limit.
+
+    Usage:
+        retention = RetentionManager("output", "output/retention.db", max_bytes=2 * 1024 ** 3)
+        retention.track(path)
+        retention.mark_uploaded(path)
+        while retention.enforce():
+            pass
+    """
+
+    def __init__(self, root, index_path, max_bytes=0, max_age_days=0, batch_size=200, logger=None):
+        self.root = os.path.abspath(root)
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.batch_size = batch_size
+        self.logger = logger or logging.getLogger(__name__)
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self._local = threading.local()
+        self.is_new = not os.path.exists(index_path)
+        self._connection().execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                written_at REAL NOT NULL,
+                uploaded INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self._connection().execute("CREATE INDEX IF NOT EXISTS idx_files_uploaded ON files (uploaded, written_at)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=10, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root)
+
+    def track(self, path, uploaded=False, written_at=None):
+        """Register a file (again, if rewritten) with its current size."""
+        self._connection().execute(
+            "INSERT OR REPLACE INTO files (path, size, written_at, uploaded) VALUES (?, ?, ?, ?)",
+            (self._key(path), os.path.getsize(path), written_at or time.time(), int(uploaded))
+        )
+
+    def mark_uploaded(self, path):
+        """Allow a tracked file to be evicted; untracked files are registered first."""
+        if self._connection().execute("UPDATE files SET uploaded = 1 WHERE path = ?",
+                                      (self._key(path),)).rowcount == 0 and os.path.exists(path):
+            self.track(path, uploaded=True, written_at=os.path.getmtime(path))
+
+    def scan(self, paths):
+        """Register existing files not in the index yet (as not uploaded); returns how many."""
+        added = 0
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            for path in paths:
+                stat = os.stat(path)
+                added += conn.execute(
+                    "INSERT OR IGNORE INTO files (path, size, written_at) VALUES (?, ?, ?)",
+                    (self._key(path), stat.st_size, stat.st_mtime)
+                ).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return added
+
+    def usage(self):
+        files, size, uploaded_files, uploaded_size = self._connection().execute(
+            "SELECT count(*), coalesce(sum(size), 0), coalesce(sum(uploaded), 0),"
+            " coalesce(sum(size * uploaded), 0) FROM files"
+        ).fetchone()
+        return {"files": files, "bytes": size, "uploaded_files": uploaded_files, "uploaded_bytes": uploaded_size}
+
+    def enforce(self):
+        """Delete up to batch_size uploaded files that are over the age or size budget; returns how many."""
+        conn = self._connection()
+        victims = []
+        if self.max_age_days:
+            cutoff = time.time() - self.max_age_days * 24 * 60 * 60
+            victims = conn.execute(
+                "SELECT path, size FROM files WHERE uploaded = 1 AND written_at < ? ORDER BY written_at LIMIT ?",
+                (cutoff, self.batch_size)
+            ).fetchall()
+        if not victims and self.max_bytes:
+            excess = self.usage()["bytes"] - self.max_bytes
+            for path, size in conn.execute(
+                "SELECT path, size FROM files WHERE uploaded = 1 ORDER BY written_at LIMIT ?", (self.batch_size,)
+            ):
+                if excess <= 0:
+                    break
+                victims.append((path, size))
+                excess -= size
+        for path, size in victims:
+            self._evict(path, size)
+        return len(victims)
+
+    def _evict(self, key, size):
+        path = os.path.join(self.root, key)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.error(f"Error evicting {path}: {e}")
+            return
+        self._connection().execute("DELETE FROM files WHERE path = ?", (key,))
+        self.evicted_files += 1
+        self.evicted_bytes += size
+        # Drop directories left empty (e.g. an old day folder), up to the root
+        folder = os.path.dirname(path)
+        while folder != self.root and folder.startswith(self.root):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+
+    def stats(self):
+        stats = self.usage()
+        stats.update({
+            "max_bytes": self.max_bytes,
+            "max_age_days": self.max_age_days,
+            "evicted_files": self.evicted_files,
+            "evicted_bytes": self.evicted_bytes,
+        })
+        return stats
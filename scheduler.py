@@ -0,0 +1,135 @@
+import zlib
+import queue
+import logging
+import threading
+
+class ShardedScheduler:
+    """
+    Runs tasks on a fixed set of worker lanes chosen by hashing a key.
+
+    Tasks submitted with the same key always land on the same lane, so they run one at a
+    time in submission order; tasks with different keys spread over the lanes and run in
+    parallel. With lanes=0 tasks run inline on the submitting thread.
+
+    Usage:
+        scheduler = ShardedScheduler("events", lanes=4)
+        scheduler.submit(conversation_id, handle, event, on_done=callback)
+    """
+
+    def __init__(self, name, lanes=4, logger=None):
+        self.name = name
+        self.logger = logger or logging.getLogger(__name__)
+        self._queues = [queue.Queue() for _ in range(lanes)]
+        self._processed = [0] * lanes
+        self._peak_depth = [0] * lanes
+        self._lock = threading.Lock()
+        for index, lane in enumerate(self._queues):
+            threading.Thread(target=self._run, args=(index, lane),
+                             name=f"{name}-lane-{index}", daemon=True).start()
+
+    def lane_for(self, key):
+        # crc32 rather than hash(): stable across processes and restarts
+        return zlib.crc32(str(key).encode("utf-8")) % len(self._queues)
+
+    def submit(self, key, fn, *args, on_done=None):
+        """Queue fn(*args) behind earlier tasks with the same key; on_done() runs afterwards."""
+        if not self._queues:
+            self._call(fn, args, on_done)
+            return
+        index = self.lane_for(key)
+        lane = self._queues[index]
+        lane.put((fn, args, on_done))
+        with self._lock:
+            self._peak_depth[index] = max(self._peak_depth[index], lane.qsize())
+
+    def _call(self, fn, args, on_done):
+        try:
+            fn(*args)
+        except Exception as e:
+            self.logger.error(f"Scheduler '{self.name}': task {getattr(fn, '__name__', fn)} failed: {e}")
+        finally:
+            if on_done:
+                on_done()
+
+    def _run(self, index, lane):
+        while True:
+            fn, args, on_done = lane.get()
+            self._call(fn, args, on_done)
+            with self._lock:
+                self._processed[index] += 1
+
+    def depths(self):
+        """Tasks currently waiting on each lane."""
+        return [lane.qsize() for lane in self._queues]
+
+    def stats(self):
+        """
+        Lane depth and imbalance. Imbalance is the busiest lane's count over the mean
+        (1.0 means perfectly even), for both current depth and tasks processed so far.
+        """
+        depths = self.depths()
+        with self._lock:
+            processed = list(self._processed)
+            peak = list(self._peak_depth)
+
+        def imbalance(values):
+            mean = sum(values) / len(values) if values else 0
+            return round(max(values) / mean, 2) if mean else 0.0
+
+        return {
+            "lanes": len(self._queues),
+            "depth": depths,
+            "peak_depth": peak,
+            "processed": processed,
+            "depth_imbalance": imbalance(depths),
+            "processed_imbalance": imbalance(processed),
+        }
+
+class WatermarkGate:
+    """
+    Hysteresis on a queue depth: turns on (overflowing) once the depth reaches `high` and
+    off again only when it has fallen to `low`, so the state does not flap around a single
+    threshold. Crossings are logged and counted.
+
+    Usage:
+        if gate.update(queue_depth):
+            ...divert new work...
+    """
+
+    def __init__(self, name, high, low, logger=None):
+        if not 0 <= low < high:
+            raise ValueError(f"WatermarkGate '{name}': need 0 <= low < high")
+        self.name = name
+        self.high = high
+        self.low = low
+        self.logger = logger or logging.getLogger(__name__)
+        self.overflowing = False
+        self.high_crossings = 0
+        self.low_crossings = 0
+        self.max_depth = 0
+        self._lock = threading.Lock()
+
+    def update(self, depth):
+        """Feed the current depth; returns True while overflowing."""
+        with self._lock:
+            self.max_depth = max(self.max_depth, depth)
+            if not self.overflowing and depth >= self.high:
+                self.overflowing = True
+                self.high_crossings += 1
+                self.logger.warning(f"'{self.name}' reached the high watermark ({depth} >= {self.high})")
+            elif self.overflowing and depth <= self.low:
+                self.overflowing = False
+                self.low_crossings += 1
+                self.logger.info(f"'{self.name}' back under the low watermark ({depth} <= {self.low})")
+            return self.overflowing
+
+    def stats(self):
+        with self._lock:
+            return {
+                "high": self.high,
+                "low": self.low,
+                "overflowing": self.overflowing,
+                "high_crossings": self.high_crossings,
+                "low_crossings": self.low_crossings,
+                "max_depth": self.max_depth,
+            }
@@ -0,0 +1,118 @@
+import os
+import hashlib
+import tempfile
+
+def check_folder(folder):
+    """
+    Reject folder names that could leave the storage root: absolute paths, backslashes and
+    empty, '.' or '..' segments. '/' is allowed between segments ('<channel>/<folder>').
+    """
+    if not folder or folder.startswith("/") or "\\" in folder:
+        raise ValueError(f"Invalid storage folder: {folder!r}")
+    if any(segment in ("", ".", "..") for segment in folder.split("/")):
+        raise ValueError(f"Invalid storage folder: {folder!r}")
+    return folder
+
+def check_filename(filename):
+    if not filename or filename in (".", "..") or "/" in filename or "\\" in filename:
+        raise ValueError(f"Invalid storage filename: {filename!r}")
+    return filename
+
+class StorageBackend:
+    """
+    Where uploaded media ends up. `folder` is a logical folder name such as a
+    day folder ("2025-03-15") or an album name; put() returns the backend's key
+    for the stored object (Drive file ID, content hash, object key, ...).
+    """
+
+    name = "base"
+
+    def ensure_folder(self, folder):
+        """Prepare a folder ahead of the first put(); returns a reference to it."""
+        return folder
+
+    def put(self, content, filename, folder, mimetype):
+        raise NotImplementedError
+
+class LocalCASStorage(StorageBackend):
+    """
+    Content-addressable store on the local filesystem.
+
+    Each distinct content is written once to objects/<h[:2]>/<h[2:4]>/<sha256>;
+    the browsable <folder>/<filename> path is a hardlink to that object, so
+    re-sent photos cost no extra space. Falls back to a copy where hardlinks
+    are not supported.
+    """
+
+    name = "local"
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        self.objects_dir = os.path.join(self.root, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    def object_path(self, content_hash):
+        return os.path.join(self.objects_dir, content_hash[:2], content_hash[2:4], content_hash)
+
+    def folder_path(self, folder):
+        """Directory of a folder, which must resolve (symlinks included) to somewhere under the root."""
+        path = os.path.realpath(os.path.join(self.root, check_folder(folder)))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Storage folder {folder!r} is outside {self.root}")
+        return path
+
+    def ensure_folder(self, folder):
+        self.folder_path(folder)
+        return folder
+
+    def put(self, content, filename, folder, mimetype):
+        folder_dir = self.folder_path(folder)
+        check_filename(filename)
+        content_hash = hashlib.sha256(content).hexdigest()
+        object_path = self.object_path(content_hash)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(object_path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, object_path)
+        os.makedirs(folder_dir, exist_ok=True)
+        link_path = os.path.join(folder_dir, filename)
+        if not os.path.exists(link_path):
+            try:
+                os.link(object_path, link_path)
+            except OSError:
+                with open(link_path, "wb") as f:
+                    f.write(content)
+        return content_hash
+
+class S3Storage(StorageBackend):
+    """
+    Any S3-compatible endpoint (AWS S3, MinIO, ...). Objects are stored as
+    <prefix><folder>/<filename>. Needs boto3, which is only imported when used.
+    """
+
+    name = "s3"
+
+    def __init__(self, bucket, endpoint_url=None, prefix="", access_key=None, secret_key=None, region=None):
+        try:
+            import boto3
+        except ImportError:
+            raise Exception("STORAGE_BACKEND=s3 requires boto3 (pip install boto3).")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client(
+            "s3", endpoint_url=endpoint_url, region_name=region,
+            aws_access_key_id=access_key, aws_secret_access_key=secret_key
+        )
+
+    def ensure_folder(self, folder):
+        return check_folder(folder)
+
+    def put(self, content, filename, folder, mimetype):
+        key = f"{self.prefix}{check_folder(folder)}/{check_filename(filename)}"
+        self.client.put_object(
+            Bucket=self.bucket, Key=key, Body=content, ContentType=mimetype,
+            Metadata={"sha256": hashlib.sha256(content).hexdigest()}
+        )
+        return key
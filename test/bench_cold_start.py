@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import json
+import hmac
+import base64
+import hashlib
+import subprocess
+import urllib.request
+import urllib.error
+
+# Run from the repository root with the usual app environment variables set
+# (LINE_CHANNEL_SECRET, PG*, GOOGLE_DRIVE_FOLDER_ID, USER_MAPPING_JSON, ...).
+# PORT is overridden so the benchmark does not clash with a running instance.
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_PORT = int(os.getenv("BENCH_PORT", "8765"))
+TOP_N = 15
+
+def import_time_report(top_n=TOP_N):
+    """Print the modules with the largest cumulative import time (python -X importtime)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=ROOT_DIR, capture_output=True, text=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|", 2)
+        rows.append((int(cumulative_us), int(self_us), module.rstrip()))
+    rows.sort(reverse=True)
+    print(f"Top {top_n} imports by cumulative time:")
+    print(f"{'cumulative ms':>14} {'self ms':>8}  module")
+    for cumulative_us, self_us, module in rows[:top_n]:
+        print(f"{cumulative_us / 1000:14.1f} {self_us / 1000:8.1f}  {module}")
+
+def signed_callback_request(port):
+    """A webhook request with no events, signed with LINE_CHANNEL_SECRET."""
+    body = json.dumps({"destination": "bench", "events": []}).encode("utf-8")
+    secret = os.environ["LINE_CHANNEL_SECRET"].encode("utf-8")
+    signature = base64.b64encode(hmac.new(secret, body, hashlib.sha256).digest()).decode("utf-8")
+    return urllib.request.Request(
+        f"http://127.0.0.1:{port}/callback", data=body, method="POST",
+        headers={"Content-Type": "application/json", "X-Line-Signature": signature}
+    )
+
+def time_to_first_200(port=BENCH_PORT, timeout=60):
+    """Start 'python app.py' and return seconds until /callback first answers 200."""
+    env = dict(os.environ, PORT=str(port))
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "app.py"], cwd=ROOT_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(signed_callback_request(port), timeout=5) as resp:
+                    if resp.status == 200:
+                        return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.02)
+        raise TimeoutError(f"app did not answer 200 within {timeout}s")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+if __name__ == "__main__":
+    import_time_report()
+    runs = [time_to_first_200() for _ in range(int(os.getenv("BENCH_RUNS", "3")))]
+    print("\nTime to first 200 on /callback: " + ", ".join(f"{r:.2f}s" for r in runs))
+    print(f"Best: {min(runs):.2f}s")
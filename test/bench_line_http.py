@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import socket
+import time
+import argparse
+import warnings
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from linebot import LineBotApi
+from line_http import PooledHttpClient
+
+# Content and profile fetch latency with the SDK's default client vs. PooledHttpClient,
+# against a local keep-alive stand-in for api.line.me / api-data.line.me.
+#   python test/bench_line_http.py --count 200 --size-kb 512
+
+class StandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    payload = b""
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out as separate writes; avoid Nagle/delayed-ACK stalls on keep-alive
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        StandIn.connections += 1
+
+    def do_GET(self):
+        if self.path.endswith("/content"):
+            body, content_type = StandIn.payload, "video/mp4"
+        else:
+            body, content_type = json.dumps({"userId": "U0", "displayName": "bench"}).encode(), "application/json"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def run(label, api, count):
+    StandIn.connections = 0
+    started = time.perf_counter()
+    for i in range(count):
+        api.get_message_content(str(i)).content
+        api.get_profile(f"U{i}")
+    elapsed = time.perf_counter() - started
+    calls = count * 2
+    print(f"{label:<10}{calls:>8}{StandIn.connections:>8}{elapsed:>10.2f}{elapsed / calls * 1000:>10.2f}")
+
+def main():
+    warnings.simplefilter("ignore")
+    parser = argparse.ArgumentParser(description="LINE API HTTP client benchmark.")
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--size-kb", type=int, default=512)
+    args = parser.parse_args()
+    StandIn.payload = os.urandom(args.size_kb * 1024)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_port}"
+
+    print(f"{'client':<10}{'calls':>8}{'conns':>8}{'seconds':>10}{'ms/call':>10}")
+    run("default", LineBotApi("bench", endpoint=endpoint, data_endpoint=endpoint), args.count)
+    pooled = LineBotApi("bench", endpoint=endpoint, data_endpoint=endpoint, timeout=(3.05, 30),
+                        http_client=PooledHttpClient)
+    run("pooled", pooled, args.count)
+    print(json.dumps(pooled.http_client.stats(), indent=2))
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from storage import LocalCASStorage, S3Storage
+
+# Throughput of each storage backend for synthetic media.
+#   python test/bench_storage.py --count 50 --size-kb 2048 [--drive]
+# S3 uses S3_ENDPOINT_URL/S3_BUCKET when set (e.g. a local MinIO); otherwise it starts
+# moto's in-process S3 server as a MinIO-style stand-in (pip install "moto[server]").
+# --drive benchmarks the real Drive backend and needs the app's environment variables.
+
+def start_s3_stand_in():
+    """Start moto's S3-compatible server on a free port; returns (endpoint_url, server)."""
+    from moto.server import ThreadedMotoServer
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    return f"http://{host}:{port}", server
+
+def make_payloads(count, size):
+    """Distinct payloads, plus one repeat of the first to exercise deduplication."""
+    payloads = [os.urandom(size) for _ in range(count)]
+    return payloads + payloads[:1]
+
+def run(backend, payloads):
+    started = time.perf_counter()
+    for i, content in enumerate(payloads):
+        backend.put(content, f"bench_{i:05d}.jpg", "bench", "image/jpeg")
+    elapsed = time.perf_counter() - started
+    total_mb = sum(len(p) for p in payloads) / (1024 * 1024)
+    print(f"{backend.name:<8}{len(payloads):>8}{total_mb:>10.1f}{elapsed:>10.2f}"
+          f"{len(payloads) / elapsed:>10.1f}{total_mb / elapsed:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Storage backend throughput benchmark.")
+    parser.add_argument("--count", type=int, default=50)
+    parser.add_argument("--size-kb", type=int, default=1024)
+    parser.add_argument("--drive", action="store_true", help="also benchmark Google Drive")
+    args = parser.parse_args()
+    payloads = make_payloads(args.count, args.size_kb * 1024)
+
+    print(f"{'backend':<8}{'files':>8}{'MB':>10}{'seconds':>10}{'files/s':>10}{'MB/s':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        run(LocalCASStorage(tmp_dir), payloads)
+
+    server = None
+    endpoint_url = os.getenv("S3_ENDPOINT_URL")
+    bucket = os.getenv("S3_BUCKET", "bench")
+    if not endpoint_url:
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+        endpoint_url, server = start_s3_stand_in()
+    try:
+        s3 = S3Storage(bucket, endpoint_url=endpoint_url, region="us-east-1",
+                       access_key=os.getenv("S3_ACCESS_KEY_ID"), secret_key=os.getenv("S3_SECRET_ACCESS_KEY"))
+        if server:
+            s3.client.create_bucket(Bucket=bucket)
+        run(s3, payloads)
+    finally:
+        if server:
+            server.stop()
+
+    if args.drive:
+        from app import DriveStorage
+        run(DriveStorage(), payloads)
+
+if __name__ == "__main__":
+    main()
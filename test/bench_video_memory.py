@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Peak-memory regression check for handle_video_message. Each size runs in a fresh process
+# that downloads a synthetic video from a local LINE content stand-in and stores it with the
+# local storage backend; the check fails if the handler raises peak RSS by more than
+#   --ratio x video size + --overhead-mb
+# The video is held in memory once while it is stored, so the default ratio of 1.1 leaves
+# room for buffer growth but fails as soon as anything keeps a second copy.
+#   python test/bench_video_memory.py [--sizes 10 100 500] [--ratio 1.1] [--overhead-mb 64]
+# Exits with status 1 when any size is over budget.
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHUNK = os.urandom(1024 * 1024)
+
+class ContentStandIn(BaseHTTPRequestHandler):
+    """Serves /v2/bot/message/<size in MB>/content as that many MB, streamed from one chunk."""
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        size_mb = int(self.path.split("/")[4])
+        self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(size_mb * len(CHUNK)))
+        self.end_headers()
+        for _ in range(size_mb):
+            self.wfile.write(CHUNK)
+
+    def log_message(self, *args):
+        pass
+
+def child(size_mb, endpoint):
+    """Run one video through the handler in this process; prints the result as JSON."""
+    sys.path.insert(0, ROOT_DIR)
+    import app
+    from linebot import LineBotApi
+    from linebot.models import MessageEvent, VideoMessage, SourceUser
+    from linebot.models.events import DeliveryContext
+
+    channel = app.channels[app.DEFAULT_CHANNEL]
+    channel.line_bot_api = LineBotApi("bench", endpoint=endpoint, data_endpoint=endpoint,
+                                      http_client=lambda timeout: app.line_http_client)
+    app.get_profile_name = lambda user_id: "bench"
+    event = MessageEvent(
+        timestamp=1700000000000, source=SourceUser(user_id="Ubench"), reply_token="bench",
+        message=VideoMessage(id=str(size_mb)), webhook_event_id=f"bench{size_mb}",
+        delivery_context=DeliveryContext(is_redelivery=False)
+    )
+    baseline_kb = app.peak_rss_kb()
+    app.dispatch_event(channel, event)
+    growth_kb = app.peak_rss_kb() - baseline_kb
+    stored = [f for _, _, files in os.walk(app.LOCAL_STORAGE_DIR) for f in files if f.endswith(".mp4")]
+    print(json.dumps({"growth_mb": growth_kb / 1024, "baseline_mb": baseline_kb / 1024, "stored": len(stored)}))
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak-memory regression check for video handling.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500], help="video sizes in MB")
+    parser.add_argument("--ratio", type=float, default=1.1, help="allowed peak RSS growth per MB of video")
+    parser.add_argument("--overhead-mb", type=float, default=64, help="allowed fixed peak RSS growth")
+    parser.add_argument("--child", nargs=2, metavar=("SIZE_MB", "ENDPOINT"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(int(args.child[0]), args.child[1])
+        return
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ContentStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_port}"
+    env = dict(os.environ, STORAGE_BACKEND="local", EVENT_LANES="0", SEQUENCE_COUNTER="memory")
+    for name, value in {"LINE_CHANNEL_SECRET": "bench", "LINE_CHANNEL_ACCESS_TOKEN": "bench",
+                        "PGHOST": "127.0.0.1", "PGPORT": "1", "PGDATABASE": "bench", "PGUSER": "bench",
+                        "PGPASSWORD": "bench", "GOOGLE_DRIVE_FOLDER_ID": "bench", "PORT": "0",
+                        "USER_MAPPING_JSON": "{}"}.items():
+        env.setdefault(name, value)
+
+    print(f"{'video MB':>9}{'growth MB':>11}{'budget MB':>11}  result")
+    failures = 0
+    for size_mb in args.sizes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            env["LOCAL_STORAGE_DIR"] = os.path.join(work_dir, "storage")
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", str(size_mb), endpoint],
+                cwd=work_dir, env=env, capture_output=True, text=True
+            )
+        if result.returncode != 0 or not result.stdout.strip():
+            print(f"{size_mb:>9}{'-':>11}{'-':>11}  ERROR\n{result.stderr[-2000:]}")
+            failures += 1
+            continue
+        measured = json.loads(result.stdout.strip().splitlines()[-1])
+        budget = size_mb * args.ratio + args.overhead_mb
+        ok = measured["stored"] == 1 and measured["growth_mb"] <= budget
+        failures += not ok
+        note = "ok" if ok else ("FAIL (not stored)" if measured["stored"] != 1 else "FAIL (over budget)")
+        print(f"{size_mb:>9}{measured['growth_mb']:>11.1f}{budget:>11.1f}  {note}")
+    server.shutdown()
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import pytest
+
+@pytest.fixture
+def make_writer(app_module):
+    """BatchedWriters registered under throwaway names, unregistered afterwards."""
+    names = []
+
+    def make(insert_sql):
+        name = f"test-{len(names)}"
+        names.append(name)
+        return app_module.BatchedWriter(name, insert_sql, batch_size=1000, interval=60)
+
+    yield make
+    for name in names:
+        app_module.batched_writers.pop(name, None)
+
+def test_flush_returns_rows_it_could_not_write(make_writer):
+    writer = make_writer("INSERT INTO test_missing_table (n) VALUES %s")
+    rows = [(1,), (2,), (3,)]
+    for row in rows:
+        writer.add(row)
+    assert writer.flush() == rows
+    # The failed rows are handed to the caller, not kept for the next flush
+    assert writer.flush() == []
+
+def test_flush_writes_rows_and_returns_nothing(make_writer, db):
+    with db() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS test_batched_writer; CREATE TABLE test_batched_writer (n INT);")
+    try:
+        writer = make_writer("INSERT INTO test_batched_writer (n) VALUES %s")
+        for n in range(5):
+            writer.add((n,))
+        assert writer.flush() == []
+        with db() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT array_agg(n ORDER BY n) FROM test_batched_writer;")
+                assert cur.fetchone()[0] == [0, 1, 2, 3, 4]
+    finally:
+        with db() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DROP TABLE IF EXISTS test_batched_writer;")
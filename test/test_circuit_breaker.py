@@ -0,0 +1,100 @@
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", clock)
+    return clock
+
+def make_breaker():
+    return CircuitBreaker("test", window=4, min_calls=2, failure_rate=0.5,
+                          slow_call_seconds=5.0, slow_call_rate=0.5, open_seconds=60.0)
+
+def fail(breaker, times=1, elapsed=0.1):
+    for _ in range(times):
+        permit = breaker.allow_request()
+        assert permit
+        breaker.record(False, elapsed, permit)
+
+def test_stays_closed_below_min_calls(clock):
+    breaker = make_breaker()
+    fail(breaker)
+    assert breaker.state == CLOSED
+    assert breaker.allow_request()
+
+def test_opens_on_failure_rate_and_rejects_until_due(clock):
+    breaker = make_breaker()
+    fail(breaker, 2)
+    assert breaker.state == OPEN
+    assert breaker.is_open()
+    assert not breaker.allow_request()
+    clock.now += 59
+    assert not breaker.allow_request()
+
+def test_opens_on_slow_call_rate(clock):
+    breaker = make_breaker()
+    for _ in range(2):
+        permit = breaker.allow_request()
+        breaker.record(True, 6.0, permit)
+    assert breaker.state == OPEN
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = make_breaker()
+    fail(breaker, 2)
+    clock.now += 60
+    assert not breaker.is_open()
+    probe = breaker.allow_request()
+    assert probe
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow_request()
+
+def test_successful_probe_closes(clock):
+    breaker = make_breaker()
+    fail(breaker, 2)
+    clock.now += 60
+    breaker.record(True, 0.1, breaker.allow_request())
+    assert breaker.state == CLOSED
+    # The window starts over: one failure is below min_calls again
+    fail(breaker)
+    assert breaker.state == CLOSED
+
+def test_failed_or_slow_probe_reopens(clock):
+    breaker = make_breaker()
+    fail(breaker, 2)
+    clock.now += 60
+    breaker.record(False, 0.1, breaker.allow_request())
+    assert breaker.state == OPEN
+    assert not breaker.allow_request()
+    clock.now += 60
+    breaker.record(True, 6.0, breaker.allow_request())
+    assert breaker.state == OPEN
+
+def test_call_started_while_closed_does_not_decide_half_open(clock):
+    breaker = make_breaker()
+    straggler = breaker.allow_request()
+    fail(breaker, 2)
+    clock.now += 60
+    probe = breaker.allow_request()
+    breaker.record(True, 0.1, straggler)
+    assert breaker.state == HALF_OPEN
+    breaker.record(False, 0.1, straggler)
+    assert breaker.state == HALF_OPEN
+    breaker.record(True, 0.1, probe)
+    assert breaker.state == CLOSED
+
+def test_result_recorded_while_open_is_ignored(clock):
+    breaker = make_breaker()
+    straggler = breaker.allow_request()
+    fail(breaker, 2)
+    breaker.record(True, 0.1, straggler)
+    assert breaker.state == OPEN
@@ -0,0 +1,69 @@
+import threading
+from datetime import datetime, timedelta
+
+from counters import SlidingWindowCounter, SQLiteSequenceCounter
+
+THREADS = 8
+PER_THREAD = 25
+
+def run_concurrently(counter, key, dt):
+    """Call counter.next(key, dt) from several threads at once; returns every value handed out."""
+    values = []
+    lock = threading.Lock()
+    start = threading.Barrier(THREADS)
+
+    def worker():
+        start.wait()
+        for _ in range(PER_THREAD):
+            value = counter.next(key, dt)
+            with lock:
+                values.append(value)
+
+    threads = [threading.Thread(target=worker) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return values
+
+def assert_unique_and_gapless(values):
+    assert sorted(values) == list(range(1, THREADS * PER_THREAD + 1))
+
+def test_sliding_window_counter_counts_per_key_and_minute():
+    counter = SlidingWindowCounter(horizon_minutes=60)
+    dt = datetime(2025, 3, 15, 10, 0, 30)
+    assert [counter.next(("U1", "video"), dt) for _ in range(3)] == [1, 2, 3]
+    assert counter.next(("U2", "video"), dt) == 1
+    assert counter.next(("U1", "video"), dt + timedelta(minutes=1)) == 1
+
+def test_sliding_window_counter_evicts_minutes_past_the_horizon():
+    counter = SlidingWindowCounter(horizon_minutes=5)
+    start = datetime(2025, 3, 15, 10, 0)
+    for minute in range(5):
+        counter.next("U1", start + timedelta(minutes=minute))
+    assert len(counter) == 5
+    counter.next("U1", start + timedelta(minutes=30))
+    assert len(counter) == 1
+    # An evicted minute starts over
+    assert counter.next("U1", start) == 1
+
+def test_sliding_window_counter_is_unique_under_threads():
+    assert_unique_and_gapless(run_concurrently(SlidingWindowCounter(), ("U1", "video"), datetime.now()))
+
+def test_sqlite_counter_is_unique_under_threads(tmp_path):
+    counter = SQLiteSequenceCounter(str(tmp_path / "sequences.db"))
+    assert_unique_and_gapless(run_concurrently(counter, ("U1", "video"), datetime.now()))
+
+def test_sqlite_counter_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "sequences.db")
+    dt = datetime.now()
+    assert SQLiteSequenceCounter(path).next("U1", dt) == 1
+    assert SQLiteSequenceCounter(path).next("U1", dt) == 2
+
+def test_postgres_counter_is_unique_under_threads(app_module, db):
+    with db() as conn:
+        with conn.cursor() as cur:
+            app_module.migrate_media_sequences(cur)
+            cur.execute("DELETE FROM media_sequences WHERE counter_key LIKE 'test|%';")
+    counter = app_module.PostgresSequenceCounter()
+    assert_unique_and_gapless(run_concurrently(counter, ("test", "video"), datetime.now()))
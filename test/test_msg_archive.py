@@ -0,0 +1,51 @@
+import os
+from datetime import datetime
+
+from msg_archive import MessageArchive
+
+def write_day(tmp_path, day, lines):
+    path = tmp_path / f"{day}_msg.txt"
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+    return str(path)
+
+DAY_ONE = ["09:00 | Joyce | 早安", "09:05 | Ken | hello", "續行", "10:00 | Joyce | 我的假期"]
+DAY_TWO = ["08:30 | Ken | second day", "08:31 | Joyce | 第二天"]
+
+def test_round_trip_by_user_and_time(tmp_path):
+    archive = MessageArchive(str(tmp_path / "archive"), block_records=1)
+    assert archive.compact_day("2025-03-15", write_day(tmp_path, "2025-03-15", DAY_ONE)) == 3
+    assert archive.is_compacted("2025-03-15")
+    assert list(archive.query()) == [
+        (datetime(2025, 3, 15, 9, 0), "Joyce", "早安"),
+        (datetime(2025, 3, 15, 9, 5), "Ken", "hello\n續行"),
+        (datetime(2025, 3, 15, 10, 0), "Joyce", "我的假期"),
+    ]
+    assert [text for _, _, text in archive.query(user="Joyce", start=datetime(2025, 3, 15, 9, 30))] == ["我的假期"]
+
+def test_round_trip_after_compaction_stopped_before_its_index(tmp_path):
+    archive_dir = str(tmp_path / "archive")
+    archive = MessageArchive(archive_dir)
+    archive.compact_day("2025-03-15", write_day(tmp_path, "2025-03-15", DAY_ONE))
+    # A run that appended blocks but stopped before writing the index
+    with open(os.path.join(archive_dir, "2025-03.blocks"), "ab") as f:
+        f.write(b"half-written block")
+    archive = MessageArchive(archive_dir)
+    assert not archive.is_compacted("2025-03-16")
+    assert archive.compact_day("2025-03-16", write_day(tmp_path, "2025-03-16", DAY_TWO)) == 2
+    assert os.path.getsize(os.path.join(archive_dir, "2025-03.blocks")) == archive.load_index("2025-03")["size"]
+    assert [(dt.day, name) for dt, name, _ in archive.query()] == [
+        (15, "Joyce"), (15, "Ken"), (15, "Joyce"), (16, "Ken"), (16, "Joyce")
+    ]
+
+def test_compacting_a_file_again_after_an_interrupted_run_adds_nothing(tmp_path):
+    archive_dir = str(tmp_path / "archive")
+    path = write_day(tmp_path, "2025-03-15", DAY_ONE)
+    MessageArchive(archive_dir).compact_day("2025-03-15", path)
+    # The run stopped after the index was written but before the source was removed
+    archive = MessageArchive(archive_dir)
+    assert archive.compact_day("2025-03-15", path) == 0
+    assert len(list(archive.query())) == 3
+    # Lines that arrived after the day's file was compacted and removed are appended
+    later = write_day(tmp_path, "2025-03-15", ["23:59 | Ken | late"])
+    assert archive.compact_day("2025-03-15", later) == 1
+    assert [text for _, _, text in archive.query(user="Ken")] == ["hello\n續行", "late"]
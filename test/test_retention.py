@@ -0,0 +1,63 @@
+import os
+import time
+
+from retention import RetentionManager
+
+DAY = 24 * 60 * 60
+
+def write(root, name, size=100, age_days=0):
+    path = os.path.join(root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    written_at = time.time() - age_days * DAY
+    os.utime(path, (written_at, written_at))
+    return path, written_at
+
+def test_enforce_deletes_only_uploaded_files_over_the_size_budget(tmp_path):
+    root = str(tmp_path / "output")
+    retention = RetentionManager(root, str(tmp_path / "retention.db"), max_bytes=250)
+    paths = []
+    for n in range(5):
+        path, written_at = write(root, f"2025-03-1{n}/{n}.jpg", age_days=10 - n)
+        retention.track(path, written_at=written_at)
+        paths.append(path)
+    # Nothing is marked uploaded: over budget, but nothing may be deleted
+    while retention.enforce():
+        pass
+    assert all(os.path.exists(path) for path in paths)
+    retention.mark_uploaded(paths[0])
+    retention.mark_uploaded(paths[3])
+    while retention.enforce():
+        pass
+    assert [os.path.exists(path) for path in paths] == [False, True, True, False, True]
+    # Evicted day folders are removed when left empty
+    assert not os.path.exists(os.path.dirname(paths[0]))
+    assert retention.stats()["evicted_files"] == 2
+
+def test_enforce_deletes_only_uploaded_files_over_the_age_budget(tmp_path):
+    root = str(tmp_path / "output")
+    retention = RetentionManager(root, str(tmp_path / "retention.db"), max_age_days=7)
+    old_uploaded, written_at = write(root, "2025-03-01/a.jpg", age_days=30)
+    retention.track(old_uploaded, written_at=written_at)
+    retention.mark_uploaded(old_uploaded)
+    old_local, written_at = write(root, "2025-03-01/b.jpg", age_days=30)
+    retention.track(old_local, written_at=written_at)
+    new_uploaded, written_at = write(root, "2025-03-20/c.jpg", age_days=1)
+    retention.track(new_uploaded, uploaded=True, written_at=written_at)
+    assert retention.enforce() == 1
+    assert retention.enforce() == 0
+    assert not os.path.exists(old_uploaded)
+    assert os.path.exists(old_local) and os.path.exists(new_uploaded)
+
+def test_scanned_files_are_not_uploaded_until_marked(tmp_path):
+    root = str(tmp_path / "output")
+    retention = RetentionManager(root, str(tmp_path / "retention.db"), max_bytes=1)
+    path, _ = write(root, "2025-03-01/a.jpg", age_days=3)
+    assert retention.scan([path]) == 1
+    assert retention.enforce() == 0
+    assert os.path.exists(path)
+    # Marking an untracked file registers it as uploaded
+    other, _ = write(root, "2025-03-02/b.jpg")
+    retention.mark_uploaded(other)
+    assert retention.usage()["uploaded_files"] == 1
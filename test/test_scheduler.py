@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from scheduler import ShardedScheduler, WatermarkGate
+
+def run_all(scheduler, tasks):
+    """Submit (key, value) tasks; returns {key: [(value, thread name), ...]} once all have run."""
+    results = {}
+    lock = threading.Lock()
+    done = threading.Semaphore(0)
+
+    def task(key, value):
+        with lock:
+            results.setdefault(key, []).append((value, threading.current_thread().name))
+
+    for key, value in tasks:
+        scheduler.submit(key, task, key, value, on_done=done.release)
+    for _ in tasks:
+        assert done.acquire(timeout=5)
+    return results
+
+def test_lane_for_is_stable_and_in_range():
+    scheduler = ShardedScheduler("test-stable", lanes=4)
+    other = ShardedScheduler("test-stable-2", lanes=4)
+    for key in ("C1", "U2", "R3", 42):
+        assert 0 <= scheduler.lane_for(key) < 4
+        assert scheduler.lane_for(key) == other.lane_for(key)
+
+def test_same_key_runs_on_one_lane_in_order():
+    scheduler = ShardedScheduler("test-order", lanes=4)
+    keys = [f"C{n}" for n in range(8)]
+    results = run_all(scheduler, [(key, n) for n in range(50) for key in keys])
+    for key in keys:
+        assert [value for value, _ in results[key]] == list(range(50))
+        assert {thread for _, thread in results[key]} == {f"test-order-lane-{scheduler.lane_for(key)}"}
+
+def test_keys_spread_over_lanes():
+    scheduler = ShardedScheduler("test-spread", lanes=4)
+    assert len({scheduler.lane_for(f"U{n}") for n in range(100)}) == 4
+
+def test_zero_lanes_run_inline():
+    scheduler = ShardedScheduler("test-inline", lanes=0)
+    results = run_all(scheduler, [("C1", 1), ("C2", 2)])
+    assert results["C1"] == [(1, threading.current_thread().name)]
+
+def test_failing_task_still_calls_on_done():
+    scheduler = ShardedScheduler("test-failing", lanes=1)
+    done = threading.Event()
+
+    def boom():
+        raise RuntimeError("boom")
+
+    scheduler.submit("C1", boom, on_done=done.set)
+    assert done.wait(5)
+
+def test_watermark_gate_hysteresis():
+    gate = WatermarkGate("test", high=10, low=3)
+    assert [gate.update(depth) for depth in (0, 5, 9)] == [False, False, False]
+    assert gate.update(10)
+    # Stays on between the watermarks, on the way down and back up
+    assert [gate.update(depth) for depth in (9, 5, 4, 8)] == [True, True, True, True]
+    assert not gate.update(3)
+    assert [gate.update(depth) for depth in (5, 9)] == [False, False]
+    assert gate.update(12)
+    stats = gate.stats()
+    assert (stats["high_crossings"], stats["low_crossings"], stats["max_depth"]) == (2, 1, 12)
+
+def test_watermark_gate_rejects_inverted_watermarks():
+    with pytest.raises(ValueError):
+        WatermarkGate("test", high=3, low=3)
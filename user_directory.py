@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import select
+import logging
+import threading
+
+class UserDirectory:
+    """
+    Display names by (channel, user ID), reloaded in the background without a restart.
+
+    Each reload builds a complete new dict and swaps it in with one assignment, so readers
+    never take a lock and always see either the old or the new directory, never a mix. A
+    reload that fails (bad JSON, database down) keeps the current snapshot.
+    Subclasses implement load() and watch().
+
+    Usage:
+        directory = JsonFileUserDirectory("user_mapping.json", default_channel="default")
+        directory.start()
+        directory.get("default", user_id)  # None if unknown
+    """
+
+    name = "base"
+
+    def __init__(self, poll_interval=5.0, logger=None):
+        self.poll_interval = poll_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._snapshot = {}
+        self.version = 0
+        self.loaded_at = None
+        self.reload_errors = 0
+        self._reload_lock = threading.Lock()
+
+    def get(self, channel, user_id):
+        return self._snapshot.get((channel, user_id))
+
+    def snapshot(self):
+        """The current {(channel, user_id): name}; never modified once published."""
+        return self._snapshot
+
+    def load(self):
+        """Read the whole directory; returns {(channel, user_id): name}."""
+        raise NotImplementedError
+
+    def watch(self):
+        """Block forever, calling reload() whenever the source changes."""
+        raise NotImplementedError
+
+    def reload(self):
+        """Load and publish a new snapshot; returns True if it changed."""
+        with self._reload_lock:
+            try:
+                mapping = self.load()
+            except Exception as e:
+                self.reload_errors += 1
+                self.logger.error(f"Error reloading {self.name} user directory, keeping version {self.version}: {e}")
+                return False
+            self.loaded_at = time.time()
+            if mapping == self._snapshot:
+                return False
+            self._snapshot = mapping
+            self.version += 1
+        self.logger.info(f"Loaded {len(mapping)} user(s) from the {self.name} user directory (version {self.version})")
+        return True
+
+    def start(self):
+        self.reload()
+        threading.Thread(target=self.watch, name=f"user-directory-{self.name}", daemon=True).start()
+
+    def stats(self):
+        return {
+            "source": self.name,
+            "users": len(self._snapshot),
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "reload_errors": self.reload_errors,
+        }
+
+class JsonFileUserDirectory(UserDirectory):
+    """
+    A JSON file, reloaded when its mtime or size changes. Either {"<user_id>": "<name>"}
+    for the default channel, or {"<channel>": {"<user_id>": "<name>"}} per channel (the two
+    forms can be mixed). Edit it by writing a new file and renaming it over the old one.
+    """
+
+    name = "file"
+
+    def __init__(self, path, default_channel, poll_interval=5.0, logger=None):
+        super().__init__(poll_interval, logger)
+        self.path = path
+        self.default_channel = default_channel
+        self._signature = None
+
+    def _stat_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load(self):
+        self._signature = self._stat_signature()
+        if self._signature is None:
+            return {}
+        with open(self.path, encoding="utf-8") as f:
+            data = json.load(f)
+        mapping = {}
+        for key, value in data.items():
+            if isinstance(value, dict):
+                mapping.update(((key, user_id), name) for user_id, name in value.items())
+            else:
+                mapping[(self.default_channel, key)] = value
+        return mapping
+
+    def watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            if self._stat_signature() != self._signature:
+                self.reload()
+
+class PostgresUserDirectory(UserDirectory):
+    """
+    The user_directory table (channel, user_id, display_name). A trigger sends a NOTIFY on
+    `notify_channel` for every change; watch() LISTENs on its own connection and reloads
+    on each notification, and every poll_interval in case one was missed while reconnecting.
+    `connect` returns a new psycopg2 connection.
+    """
+
+    name = "postgres"
+
+    def __init__(self, connect, notify_channel="user_directory", poll_interval=300.0, logger=None):
+        super().__init__(poll_interval, logger)
+        self.connect = connect
+        self.notify_channel = notify_channel
+
+    def load(self):
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT channel, user_id, display_name FROM user_directory;")
+                return {(channel, user_id): name for channel, user_id, name in cur.fetchall()}
+        finally:
+            conn.close()
+
+    def watch(self):
+        while True:
+            try:
+                conn = self.connect()
+                conn.autocommit = True
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute(f"LISTEN {self.notify_channel};")
+                    self.reload()
+                    while True:
+                        select.select([conn], [], [], self.poll_interval)
+                        conn.poll()
+                        # Any number of notifications means one reload
+                        conn.notifies.clear()
+                        self.reload()
+                finally:
+                    conn.close()
+            except Exception as e:
+                self.logger.error(f"User directory listener failed, reconnecting: {e}")
+                time.sleep(min(self.poll_interval, 30))